@@ -30,31 +30,93 @@
 
 /* ************************************************************ */
 
+/* Returns 0 on success, 1 if the commands failed, -1 on error */
+static int _run_nft_buffer(const char *buf) {
+  struct nft_ctx *nft;
+  int rv;
+
+  if(!(nft = nft_ctx_new(NFT_CTX_DEFAULT))) {
+    fprintf(stderr, "nft_ctx_new failed\n");
+    return -1;
+  }
+
+#if 1
+  rv = nft_run_cmd_from_buffer(nft, buf);
+#else
+  rv = nft_run_cmd_from_buffer(nft, (char*)buf, strlen(buf));
+#endif
+
+  nft_ctx_free(nft);
+  return(rv ? 1 : 0);
+}
+
+/* ************************************************************ */
+
 /* NOTE: directly running nft with os.execute won't work because of
  * the dropped privileges. libnftables instead works with linux capabilities. */
 static PyObject *run_nft_cmd(PyObject *self, PyObject *args) {
   const char *cmd;
-  struct nft_ctx *nft;
-  
+  int rv;
+
   if (!PyArg_ParseTuple(args, "s", &cmd))
     return NULL;
 
-  if(!(nft = nft_ctx_new(NFT_CTX_DEFAULT))) {
-    fprintf(stderr, "nft_ctx_new failed\n");
+  if((rv = _run_nft_buffer(cmd)) < 0) {
+    PyErr_SetString(PyExc_RuntimeError, "nft_ctx_new failed");
     return NULL;
   }
 
-#if 1
-  if(nft_run_cmd_from_buffer(nft, cmd))
-#else
-  if(nft_run_cmd_from_buffer(nft, (char*)cmd, strlen(cmd)))
-#endif
-{
-    nft_ctx_free(nft);
+  if(rv)
     Py_RETURN_FALSE;
+
+  Py_RETURN_TRUE;
+}
+
+/* ************************************************************ */
+
+/*
+ * Run a list of commands as a single buffer. libnftables submits all the
+ * commands of a buffer to the kernel as one transaction, so either all of
+ * them are applied or none is.
+ */
+static PyObject *run_nft_batch(PyObject *self, PyObject *args) {
+  PyObject *cmds, *sep, *buf;
+  const char *cbuf;
+  int rv;
+
+  if (!PyArg_ParseTuple(args, "O", &cmds))
+    return NULL;
+
+  if(!(sep = PyUnicode_FromString("\n")))
+    return NULL;
+
+  buf = PyUnicode_Join(sep, cmds);
+  Py_DECREF(sep);
+
+  if(!buf)
+    return NULL;
+
+  if(PyUnicode_GET_LENGTH(buf) == 0) {
+    Py_DECREF(buf);
+    Py_RETURN_TRUE;
   }
 
-  nft_ctx_free(nft);
+  if(!(cbuf = PyUnicode_AsUTF8(buf))) {
+    Py_DECREF(buf);
+    return NULL;
+  }
+
+  rv = _run_nft_buffer(cbuf);
+  Py_DECREF(buf);
+
+  if(rv < 0) {
+    PyErr_SetString(PyExc_RuntimeError, "nft_ctx_new failed");
+    return NULL;
+  }
+
+  if(rv)
+    Py_RETURN_FALSE;
+
   Py_RETURN_TRUE;
 }
 
@@ -78,6 +140,7 @@ static PyObject *get_iface_ip(PyObject *self, PyObject *args) {
 
 static PyMethodDef nfwMethods[] = {
   {"run", run_nft_cmd, METH_VARARGS, "Run nftables commands"},
+  {"run_batch", run_nft_batch, METH_VARARGS, "Run a list of nftables commands as a single atomic transaction"},
   {"get_iface_ip", get_iface_ip, METH_VARARGS, "Get an interface IP address"},
   {NULL, NULL, 0, NULL}  /* Sentinel */
 };
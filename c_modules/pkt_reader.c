@@ -25,6 +25,9 @@
 #include <arpa/inet.h>
 #include <netinet/ip.h>
 #include <unistd.h>
+#include <poll.h>
+#include <errno.h>
+#include <sys/socket.h>
 
 #include "headers.h"
 #include "netutils.c"
@@ -32,10 +35,20 @@
 #define SNAPLEN 1024
 #define PROMISC 1
 
+// Block timeout of the capture ring in immediate mode
+#define RING_IMMEDIATE_TIMEOUT_MS 10
+
+#include "tpacket_ring.c"
+
 #define min(x, y) ((x) <= (y) ? (x) : (y))
 
+// Maximum number of packets returned by a read_packets call
+#define MAX_READ_BATCH 512
+
+// Maximum number of frames sent by a single sendmmsg
+#define MAX_SEND_BATCH 64
+
 //#define DEBUG
-//#define USE_SAMPLE_PCAP
 
 typedef struct {
   char mac_buf[18];
@@ -43,12 +56,16 @@ typedef struct {
   char name_buf[64];
   char dns_buf[128];
   char proto[32];
+  double tstamp;
 } PacketInfo;
 
 typedef struct {
   PyObject_HEAD
 
   pcap_t *handle;
+  // Set instead of the handle when capturing with the TPACKET_V3 ring
+  TPacketRing *ring;
+  int offline;
   u_char iface_mac[6];
   u_char gateway_mac[6];
   char lan_network[64];
@@ -75,9 +92,38 @@ static int parse_mac(const char *m, u_char *parsed) {
 
 /* ************************************************************ */
 
+/* Check the datalink and install the filter. The handle is closed on error. */
+static pcap_t* _setup_capture(pcap_t *handle, const char *devname, const char *filter_exp) {
+  struct bpf_program fp;
+
+  if (pcap_datalink(handle) != DLT_EN10MB) {
+    fprintf(stderr, "Device %s doesn't provide Ethernet headers - not supported\n", devname);
+    pcap_close(handle);
+    return NULL;
+  }
+
+  if (pcap_compile(handle, &fp, filter_exp, 1, PCAP_NETMASK_UNKNOWN) == -1) {
+    fprintf(stderr, "Couldn't parse filter %s: %s\n", filter_exp, pcap_geterr(handle));
+    pcap_close(handle);
+    return NULL;
+  }
+
+  if (pcap_setfilter(handle, &fp) == -1) {
+    fprintf(stderr, "Couldn't install filter %s: %s\n", filter_exp, pcap_geterr(handle));
+    pcap_freecode(&fp);
+    pcap_close(handle);
+    return NULL;
+  }
+
+  pcap_freecode(&fp);
+
+  return handle;
+}
+
+/* ************************************************************ */
+
 static pcap_t* _open_capture_dev(const char *devname, int read_timeout, const char *filter_exp, int immediate_mode) {
   char errbuf[PCAP_ERRBUF_SIZE];
-  struct bpf_program fp;
   pcap_t *handle = NULL;
   
   // Note for packet timeout: heavy buffering makes timouts impredictable
@@ -95,11 +141,7 @@ static pcap_t* _open_capture_dev(const char *devname, int read_timeout, const ch
               if (pcap_activate(_handle) == 0)
                 handle = _handle;
  } else {
-#if ! defined USE_SAMPLE_PCAP
-  handle = pcap_open_live(devname, SNAPLEN, PROMISC, read_timeout, errbuf);
-#else
-  handle = pcap_open_offline("dhcp.pcap", errbuf);
-#endif
+    handle = pcap_open_live(devname, SNAPLEN, PROMISC, read_timeout, errbuf);
   }
 
   if (handle == NULL) {
@@ -107,28 +149,21 @@ static pcap_t* _open_capture_dev(const char *devname, int read_timeout, const ch
     return NULL;
   }
 
-  if (pcap_datalink(handle) != DLT_EN10MB) {
-    fprintf(stderr, "Device %s doesn't provide Ethernet headers - not supported\n", devname);
-    pcap_close(handle);
-    return NULL;
-  }
+  return _setup_capture(handle, devname, filter_exp);
+}
 
-  if (pcap_compile(handle, &fp, filter_exp, 1, PCAP_NETMASK_UNKNOWN) == -1) {
-    fprintf(stderr, "Couldn't parse filter %s: %s\n", filter_exp, pcap_geterr(handle));
-    pcap_close(handle);
-    return NULL;
-  }
+/* ************************************************************ */
 
-  if (pcap_setfilter(handle, &fp) == -1) {
-    fprintf(stderr, "Couldn't install filter %s: %s\n", filter_exp, pcap_geterr(handle));
-    pcap_freecode(&fp);
-    pcap_close(handle);
+static pcap_t* _open_capture_file(const char *path, const char *filter_exp) {
+  char errbuf[PCAP_ERRBUF_SIZE];
+  pcap_t *handle = pcap_open_offline(path, errbuf);
+
+  if (handle == NULL) {
+    fprintf(stderr, "Couldn't open file %s: %s\n", path, errbuf);
     return NULL;
   }
 
-  pcap_freecode(&fp);
-
-  return handle;
+  return _setup_capture(handle, path, filter_exp);
 }
 
 /* ************************************************************ */
@@ -137,28 +172,39 @@ static void _close_capture_dev(pcap_t *handle) {
   pcap_close(handle);
 }
 
+static void _close_reader(pkt_readerObject *reader) {
+  if (reader->ring)
+    _ring_close(reader->ring);
+  else
+    _close_capture_dev(reader->handle);
+}
+
+/* The file descriptor to poll for the packets, and to send the frames */
+static int _reader_fd(pkt_readerObject *reader) {
+  if (reader->ring)
+    return reader->ring->fd;
+
+  return pcap_get_selectable_fd(reader->handle);
+}
+
 /* ************************************************************ */
 
 /*
- * Read a packet from wire and extract relevant information.
+ * Extract the relevant information from a packet.
  *
  * If relevant information is found, 1 is returned. Otherwise 0 is returned.
  *
  * When 1 is retuned, the mac_buf and ip_buf parameters will be filled accordingly.
  * When 1 is retuned, the name_buf will only be set if a relevant name as been found.
  */
-static int _read_packet_info(pcap_t *handle, PacketInfo *pinfo) {
-  struct pcap_pkthdr header;
+static int _parse_packet_info(const struct pcap_pkthdr *header, const u_char *packet, PacketInfo *pinfo) {
   struct in_addr ip_addr;
   struct arphdr *arp;
   struct ip *ip_header;
   struct ethhdr *eth_header;
   struct udphdr *udp_header;
   int iphdr_len;
-  const u_char *packet = pcap_next(handle, &header);
-  int len = header.len;
-
-  if (! packet) return 0;
+  int len = min(header->len, header->caplen);
 
   if (len >= sizeof(struct ethhdr)) {
     eth_header = (struct ethhdr *) packet;
@@ -178,7 +224,7 @@ static int _read_packet_info(pcap_t *handle, PacketInfo *pinfo) {
           strcpy(pinfo->proto, ((ntohs(arp->oper) == ARP_REQUEST) ? "ARP_REQ" : "ARP_REP"));
 
 #ifdef DEBUG
-          printf("Got an %d bytes ARP packet\n", header.len);
+          printf("Got an %d bytes ARP packet\n", header->len);
           printf("From %s (%s) %s\n", pinfo->ip_buf, pinfo->mac_buf, pinfo->proto);
 #endif
 
@@ -197,7 +243,7 @@ static int _read_packet_info(pcap_t *handle, PacketInfo *pinfo) {
           format_mac(eth_header->h_source, pinfo->mac_buf, sizeof(pinfo->mac_buf));
 
 #ifdef DEBUG
-          printf("Got a %d bytes IPv4 [iphdr_len=%d] packet\n", header.len, iphdr_len);
+          printf("Got a %d bytes IPv4 [iphdr_len=%d] packet\n", header->len, iphdr_len);
           printf("From %s (%s)\n", pinfo->ip_buf, pinfo->mac_buf);
 #endif
 
@@ -300,28 +346,145 @@ static int _read_packet_info(pcap_t *handle, PacketInfo *pinfo) {
 
 /* ************************************************************ */
 
-static int _send_spoofed_arp(pkt_readerObject *reader,
+/* Read a packet from wire and extract relevant information, see _parse_packet_info */
+static int _read_packet_info(pcap_t *handle, PacketInfo *pinfo) {
+  struct pcap_pkthdr header;
+  const u_char *packet = pcap_next(handle, &header);
+
+  if (! packet) return 0;
+
+  return _parse_packet_info(&header, packet, pinfo);
+}
+
+/* ************************************************************ */
+
+typedef struct {
+  PacketInfo *pinfos;
+  int max_count;
+  int count;
+} PacketsBatch;
+
+static void _batch_packet_handler(u_char *user, const struct pcap_pkthdr *header, const u_char *packet) {
+  PacketsBatch *batch = (PacketsBatch *) user;
+  PacketInfo *pinfo;
+
+  if (batch->count >= batch->max_count)
+    return;
+
+  pinfo = &batch->pinfos[batch->count];
+  memset(pinfo, 0, sizeof(*pinfo));
+
+  if (_parse_packet_info(header, packet, pinfo)) {
+    pinfo->tstamp = header->ts.tv_sec + header->ts.tv_usec / 1000000.0;
+    batch->count++;
+  }
+}
+
+/*
+ * Wait up to timeout_ms (-1 to only rely on the handle read timeout) for the
+ * packets, then read up to batch->max_count packets from the capture buffer
+ * with a single pcap_dispatch. Only the packets with relevant information are
+ * stored into the batch.
+ *
+ * Returns the pcap_dispatch result, 0 on timeout.
+ */
+static int _read_packets(pkt_readerObject *reader, PacketsBatch *batch, int timeout_ms) {
+  int fd = _reader_fd(reader);
+
+  if ((timeout_ms >= 0) && (fd >= 0)) {
+    struct pollfd pfd = { .fd = fd, .events = POLLIN };
+    int rv = poll(&pfd, 1, timeout_ms);
+
+    if (rv <= 0)
+      return (rv < 0) ? -1 : 0;
+  }
+
+  if (reader->ring)
+    return _ring_dispatch(reader->ring, batch->max_count, _batch_packet_handler, (u_char *) batch);
+
+  return pcap_dispatch(reader->handle, batch->max_count, _batch_packet_handler, (u_char *) batch);
+}
+
+/* ************************************************************ */
+
+static void _build_spoofed_arp(pkt_readerObject *reader, struct arppkt *arp,
         u_int32_t target_ip, u_char *target_mac, int op_type, int poison) {
-  struct arppkt arp;
   u_char *source_mac = poison ? reader->iface_mac : reader->gateway_mac;
 
   /* Ethernet */
-  arp.proto = htons(0x0806);
-  memcpy(arp.dst_mac, target_mac, sizeof(arp.dst_mac));
-  memcpy(arp.src_mac, source_mac, sizeof(arp.src_mac));
+  arp->proto = htons(0x0806);
+  memcpy(arp->dst_mac, target_mac, sizeof(arp->dst_mac));
+  memcpy(arp->src_mac, source_mac, sizeof(arp->src_mac));
 
   /* ARP */
-  arp.arph.htype = htons(1);
-  arp.arph.ptype = htons(0x0800);
-  arp.arph.hlen = 6;
-  arp.arph.plen = 4;
-  arp.arph.oper = htons(op_type);
-  *((u_int32_t *)&arp.arph.spa) = reader->gateway_ip;
-  *((u_int32_t *)&arp.arph.tpa) = target_ip;
-  memcpy(arp.arph.tha, target_mac, sizeof(arp.dst_mac));
-  memcpy(arp.arph.sha, source_mac, sizeof(arp.src_mac));
+  arp->arph.htype = htons(1);
+  arp->arph.ptype = htons(0x0800);
+  arp->arph.hlen = 6;
+  arp->arph.plen = 4;
+  arp->arph.oper = htons(op_type);
+  *((u_int32_t *)&arp->arph.spa) = reader->gateway_ip;
+  *((u_int32_t *)&arp->arph.tpa) = target_ip;
+  memcpy(arp->arph.tha, target_mac, sizeof(arp->dst_mac));
+  memcpy(arp->arph.sha, source_mac, sizeof(arp->src_mac));
+}
+
+static int _send_frames(pkt_readerObject *reader, struct iovec *frames, int num_frames);
+
+static int _send_spoofed_arp(pkt_readerObject *reader,
+        u_int32_t target_ip, u_char *target_mac, int op_type, int poison) {
+  struct arppkt arp;
+  struct iovec frame = { .iov_base = &arp, .iov_len = sizeof(arp) };
 
-  return pcap_sendpacket(reader->handle, (u_char*)&arp, sizeof(arp));
+  _build_spoofed_arp(reader, &arp, target_ip, target_mac, op_type, poison);
+
+  return (_send_frames(reader, &frame, 1) == 1) ? 0 : -1;
+}
+
+/* ************************************************************ */
+
+/*
+ * Send the frames with as few syscalls as possible. On a live capture the
+ * selectable fd is the bound packet socket, so the frames are sent with
+ * sendmmsg. Otherwise they are sent one at a time.
+ *
+ * Returns the number of frames sent.
+ */
+static int _send_frames(pkt_readerObject *reader, struct iovec *frames, int num_frames) {
+  int sent = 0;
+
+#ifdef __linux__
+  int fd = _reader_fd(reader);
+
+  if (fd >= 0) {
+    struct mmsghdr msgs[MAX_SEND_BATCH];
+
+    while (sent < num_frames) {
+      int batch = min(num_frames - sent, MAX_SEND_BATCH);
+      int i, rv;
+
+      memset(msgs, 0, batch * sizeof(struct mmsghdr));
+
+      for (i = 0; i < batch; i++) {
+        msgs[i].msg_hdr.msg_iov = &frames[sent + i];
+        msgs[i].msg_hdr.msg_iovlen = 1;
+      }
+
+      if ((rv = sendmmsg(fd, msgs, batch, 0)) <= 0)
+        break;
+
+      sent += rv;
+    }
+
+    return sent;
+  }
+#endif
+
+  for (; sent < num_frames; sent++) {
+    if (pcap_sendpacket(reader->handle, frames[sent].iov_base, frames[sent].iov_len) != 0)
+      break;
+  }
+
+  return sent;
 }
 
 /* ************************************************************ */
@@ -409,25 +572,39 @@ static int get_gateway_info(uint32_t *gateway_ip, u_char *gateway_mac) {
 
 /* ************************************************************ */
 
+/*
+ * Open a device for capture. When use_ring is set, the packets are captured
+ * with a TPACKET_V3 mmap ring in place of libpcap.
+ */
 static PyObject *open_capture_dev(PyObject *self, PyObject *args) {
   const char *devname, *filter_exp;
   int read_timeout;
   int immediate_mode;
+  int use_ring = 0;
   int rv;
-  pcap_t *handle;
+  pcap_t *handle = NULL;
+  TPacketRing *ring = NULL;
   struct in_addr addr;
 
-  if (!PyArg_ParseTuple(args, "sisb", &devname, &read_timeout, &filter_exp, &immediate_mode))
+  if (!PyArg_ParseTuple(args, "sisb|p", &devname, &read_timeout, &filter_exp, &immediate_mode, &use_ring))
     return NULL;
 
-  handle = _open_capture_dev(devname, read_timeout, filter_exp, immediate_mode);
+  if (use_ring) {
+    ring = _ring_open(devname, filter_exp, immediate_mode ? min(read_timeout, RING_IMMEDIATE_TIMEOUT_MS) : read_timeout);
 
-  if (!handle)
-    return NULL;
+    if (!ring)
+      return NULL;
+  } else {
+    handle = _open_capture_dev(devname, read_timeout, filter_exp, immediate_mode);
+
+    if (!handle)
+      return NULL;
+  }
 
   pkt_readerObject* reader;
   reader = (pkt_readerObject*) pkt_readerType.tp_new(&pkt_readerType, NULL, NULL);
   reader->handle = handle;
+  reader->ring = ring;
 
   // Interface IP
   if((rv = get_interface_ip_address(devname, &reader->iface_ip, &reader->lan_netmask)) == -1) {
@@ -460,13 +637,45 @@ static PyObject *open_capture_dev(PyObject *self, PyObject *args) {
 
 /* ************************************************************ */
 
+/*
+ * Open a pcap file to replay its packets. No interface nor gateway information
+ * is available, and no packets can be sent.
+ */
+static PyObject *open_capture_file(PyObject *self, PyObject *args) {
+  const char *path, *filter_exp;
+  pkt_readerObject *reader;
+  pcap_t *handle;
+
+  if (!PyArg_ParseTuple(args, "ss", &path, &filter_exp))
+    return NULL;
+
+  if (!(handle = _open_capture_file(path, filter_exp))) {
+    PyErr_Format(PyExc_OSError, "Could not open the capture file %s", path);
+    return NULL;
+  }
+
+  reader = (pkt_readerObject*) pkt_readerType.tp_new(&pkt_readerType, NULL, NULL);
+
+  if (!reader) {
+    _close_capture_dev(handle);
+    return NULL;
+  }
+
+  reader->handle = handle;
+  reader->offline = 1;
+
+  return (PyObject *)reader;
+}
+
+/* ************************************************************ */
+
 static PyObject *close_capture_dev(PyObject *self, PyObject *args) {
   pkt_readerObject *reader;
 
   if (!PyArg_ParseTuple(args, "O", &reader))
     return NULL;
 
-  _close_capture_dev(reader->handle);
+  _close_reader(reader);
 
   Py_DECREF(reader);
 
@@ -485,7 +694,12 @@ static PyObject *read_packet_info(PyObject *self, PyObject *args) {
 
   memset(&pinfo, 0, sizeof(pinfo));
 
-  if (! _read_packet_info(reader->handle, &pinfo))
+  if (reader->ring) {
+    PacketsBatch batch = { .pinfos = &pinfo, .max_count = 1, .count = 0 };
+
+    if ((_read_packets(reader, &batch, -1) <= 0) || !batch.count)
+      return Py_BuildValue("s", NULL);
+  } else if (! _read_packet_info(reader->handle, &pinfo))
     return Py_BuildValue("s", NULL);
 
   dict = PyDict_New();
@@ -503,6 +717,114 @@ static PyObject *read_packet_info(PyObject *self, PyObject *args) {
 
 /* ************************************************************ */
 
+static PyObject *get_selectable_fd(PyObject *self, PyObject *args) {
+  pkt_readerObject *reader;
+
+  if (!PyArg_ParseTuple(args, "O", &reader))
+    return NULL;
+
+  return PyLong_FromLong(_reader_fd(reader));
+}
+
+/* ************************************************************ */
+
+static PyObject *set_nonblock(PyObject *self, PyObject *args) {
+  pkt_readerObject *reader;
+  char errbuf[PCAP_ERRBUF_SIZE];
+  int nonblock;
+
+  if (!PyArg_ParseTuple(args, "Op", &reader, &nonblock))
+    return NULL;
+
+  // The ring reads never block
+  if (reader->ring)
+    Py_RETURN_NONE;
+
+  if (pcap_setnonblock(reader->handle, nonblock, errbuf) != 0) {
+    PyErr_SetString(PyExc_RuntimeError, errbuf);
+    return NULL;
+  }
+
+  Py_RETURN_NONE;
+}
+
+/* ************************************************************ */
+
+static PyObject *str_or_none(const char *s) {
+  if (s[0])
+    return PyUnicode_FromString(s);
+
+  Py_RETURN_NONE;
+}
+
+/*
+ * Returns a list of (mac, ip, proto, name, query, tstamp) tuples, with None for
+ * the missing fields. The list is empty if no packets arrived within the timeout.
+ * None is returned at the end of a capture file.
+ */
+static PyObject *read_packets(PyObject *self, PyObject *args) {
+  pkt_readerObject *reader;
+  PacketsBatch batch;
+  PyObject *list;
+  double timeout;
+  int rv, i;
+
+  if (!PyArg_ParseTuple(args, "Oid", &reader, &batch.max_count, &timeout))
+    return NULL;
+
+  if ((batch.max_count <= 0) || (batch.max_count > MAX_READ_BATCH)) {
+    PyErr_Format(PyExc_ValueError, "max_count must be between 1 and %d", MAX_READ_BATCH);
+    return NULL;
+  }
+
+  batch.count = 0;
+  batch.pinfos = PyMem_RawMalloc(batch.max_count * sizeof(PacketInfo));
+
+  if (!batch.pinfos)
+    return PyErr_NoMemory();
+
+  // The packets are parsed without the GIL, the python objects are built afterwards
+  Py_BEGIN_ALLOW_THREADS
+  rv = _read_packets(reader, &batch, (timeout >= 0) ? (int)(timeout * 1000) : -1);
+  Py_END_ALLOW_THREADS
+
+  if ((rv == -1) && (batch.count == 0)) {
+    PyErr_SetString(PyExc_RuntimeError, reader->ring ? strerror(errno) : pcap_geterr(reader->handle));
+    PyMem_RawFree(batch.pinfos);
+    return NULL;
+  }
+
+  if ((rv == 0) && reader->offline) {
+    PyMem_RawFree(batch.pinfos);
+    Py_RETURN_NONE;
+  }
+
+  if (!(list = PyList_New(batch.count))) {
+    PyMem_RawFree(batch.pinfos);
+    return NULL;
+  }
+
+  for (i = 0; i < batch.count; i++) {
+    PacketInfo *pinfo = &batch.pinfos[i];
+    PyObject *record = Py_BuildValue("(NNNNNd)",
+      str_or_none(pinfo->mac_buf), str_or_none(pinfo->ip_buf), str_or_none(pinfo->proto),
+      str_or_none(pinfo->name_buf), str_or_none(pinfo->dns_buf), pinfo->tstamp);
+
+    if (!record) {
+      Py_DECREF(list);
+      list = NULL;
+      break;
+    }
+
+    PyList_SET_ITEM(list, i, record);
+  }
+
+  PyMem_RawFree(batch.pinfos);
+  return list;
+}
+
+/* ************************************************************ */
+
 static PyObject *arp_spoof(PyObject *self, PyObject *args, int arp_op, int poison) {
   pkt_readerObject *reader;
   const char *target_mac_str, *target_ip_str;
@@ -537,6 +859,78 @@ static inline PyObject *arp_rearp(PyObject *self, PyObject *args)     { return(a
 
 /* ************************************************************ */
 
+/* Returns the ARP request frame which spoofs the target, to be sent with send_frames */
+static PyObject *make_arp_req_spoof(PyObject *self, PyObject *args) {
+  pkt_readerObject *reader;
+  const char *target_mac_str, *target_ip_str;
+  uint32_t target_ip;
+  u_char target_mac[6];
+  struct arppkt arp;
+
+  if (!PyArg_ParseTuple(args, "Oss", &reader, &target_mac_str, &target_ip_str))
+    return NULL;
+
+  target_ip = inet_addr(target_ip_str);
+
+  if((target_ip == INADDR_NONE) || !parse_mac(target_mac_str, target_mac)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid target MAC or IP address");
+    return NULL;
+  }
+
+  _build_spoofed_arp(reader, &arp, target_ip, target_mac, ARP_REQUEST, 1);
+
+  return PyBytes_FromStringAndSize((const char *)&arp, sizeof(arp));
+}
+
+/* ************************************************************ */
+
+/* Send a list of prebuilt frames. Returns the number of frames sent. */
+static PyObject *send_frames(PyObject *self, PyObject *args) {
+  pkt_readerObject *reader;
+  PyObject *frames_list;
+  struct iovec *frames;
+  Py_ssize_t num_frames, i;
+  int sent;
+
+  if (!PyArg_ParseTuple(args, "OO!", &reader, &PyList_Type, &frames_list))
+    return NULL;
+
+  num_frames = PyList_GET_SIZE(frames_list);
+
+  if (num_frames == 0)
+    return PyLong_FromLong(0);
+
+  if (!(frames = PyMem_Malloc(num_frames * sizeof(struct iovec))))
+    return PyErr_NoMemory();
+
+  for (i = 0; i < num_frames; i++) {
+    PyObject *frame = PyList_GET_ITEM(frames_list, i);
+    Py_ssize_t len;
+    char *buf;
+
+    if (PyBytes_AsStringAndSize(frame, &buf, &len) != 0) {
+      PyMem_Free(frames);
+      return NULL;
+    }
+
+    frames[i].iov_base = buf;
+    frames[i].iov_len = len;
+  }
+
+  // NOTE: the list keeps the frames alive while the GIL is released
+  Py_INCREF(frames_list);
+  Py_BEGIN_ALLOW_THREADS
+  sent = _send_frames(reader, frames, num_frames);
+  Py_END_ALLOW_THREADS
+  Py_DECREF(frames_list);
+
+  PyMem_Free(frames);
+
+  return PyLong_FromLong(sent);
+}
+
+/* ************************************************************ */
+
 static PyObject *get_iface_ip(PyObject *self, PyObject *args) {
   pkt_readerObject *reader;
   struct in_addr addr;
@@ -605,12 +999,18 @@ static PyObject *get_lan_network(PyObject *self, PyObject *args) {
 /* ************************************************************ */
 
 static PyMethodDef PktReaderMethods[] = {
-  {"open_capture_dev",  open_capture_dev, METH_VARARGS, "Open a device for capture."},
+  {"open_capture_dev",  open_capture_dev, METH_VARARGS, "Open a device for capture, optionally with a TPACKET_V3 mmap ring."},
   {"close_capture_dev", close_capture_dev, METH_VARARGS, "Closes a devices capture."},
   {"read_packet_info", read_packet_info, METH_VARARGS, "Read packet information. None is returned if no packet information is available."},
+  {"get_selectable_fd", get_selectable_fd, METH_VARARGS, "Get the file descriptor to wait for packets with select, -1 if not available"},
+  {"set_nonblock", set_nonblock, METH_VARARGS, "Set the capture non-blocking mode"},
+  {"open_capture_file", open_capture_file, METH_VARARGS, "Open a pcap file to replay it."},
+  {"read_packets", read_packets, METH_VARARGS, "Read a batch of up to max_count packets, waiting up to timeout seconds. Returns a list of (mac, ip, proto, name, query, tstamp) tuples, None at the end of a capture file."},
   {"arp_req_spoof", arp_req_spoof, METH_VARARGS, "Send a spoofed ARP request"},
   {"arp_rep_spoof", arp_rep_spoof, METH_VARARGS, "Send a spoofed ARP reply"},
   {"arp_rearp", arp_rearp, METH_VARARGS, "Re-arp the device to the original gateway"},
+  {"make_arp_req_spoof", make_arp_req_spoof, METH_VARARGS, "Build the spoofed ARP request frame for the device"},
+  {"send_frames", send_frames, METH_VARARGS, "Send a list of frames in a batch. Returns the number of frames sent."},
   {"get_iface_ip", get_iface_ip, METH_VARARGS, "Get the interface IP address"},
   {"get_iface_mac", get_iface_mac, METH_VARARGS, "Get the interface MAC address"},
   {"get_gateway_mac", get_gateway_mac, METH_VARARGS, "Get the gateway MAC address"},
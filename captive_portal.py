@@ -22,6 +22,7 @@ from utils.jobs import Job
 from utils.privs import acquire_capabilities
 from urllib.parse import urlencode
 import c_modules.nft as nft
+import config
 import waitress
 import logging
 
@@ -95,11 +96,15 @@ class CaptivePortalJob(Job):
       self.cp_eventsqueue[0].send(("auth_ok", request.remote_addr))
 
     if success:
-      # Need to add the expection immediately, before redirecting the device
-      # TODO: IP should be harvested when DHCP requests are seen, otherwill
-      # the IP will be allowed forever
-      nft.run("add element ip nat cp_auth_ok { %s }" % (request.remote_addr,))
-      nft.run("add element ip filter cp_auth_ok { %s }" % (request.remote_addr,))
+      # Need to add the expection immediately, before redirecting the device.
+      # The authorization expires in the kernel after the session time, unless
+      # it is refreshed by the device traffic. The configuration is reloaded,
+      # if changed, to match the session time of the packets reader rules.
+      config.reload()
+      session_time = config.getCaptivePortalSessionTime()
+
+      nft.run_batch(["add element ip nat cp_auth_ok { %s timeout %ds }" % (request.remote_addr, session_time),
+        "add element ip filter cp_auth_ok { %s timeout %ds }" % (request.remote_addr, session_time)])
 
       return(self.GET_LoginOk())
     else:
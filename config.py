@@ -18,6 +18,7 @@
 
 import json
 import errno
+import os
 
 CONFIG_FILE = "data/config.json"
 DEVICES_CONFIG_SECTION = "devices"
@@ -25,8 +26,32 @@ USERS_CONFIG_SECTION = "users"
 GLOBAL_CONFG_SECTION = "global"
 MAX_HOST_IDLE_SEC = 300
 
+# Days of presence data to keep for each resolution before compacting it into
+# the next coarser one. 0 means forever.
+DEFAULT_RETENTION_DAYS = {
+  "1m": 30,
+  "1h": 365,
+  "24h": 0,
+}
+
+# Seconds after which an idle device must authenticate again to the captive portal
+DEFAULT_CAPTIVE_PORTAL_SESSION_SEC = 4 * 3600
+
 data = None
 
+# (inode, mtime, size) of the loaded config file, None if it does not exist
+data_stat = None
+
+# Incremented every time the configuration changes, so that the consumers
+# can tell if their cached data is stale
+generation = 0
+
+# Indexes built from the configuration:
+#  - device_users: mac -> user
+#  - device_policies: mac -> effective policy of the configured devices
+device_users = {}
+device_policies = {}
+
 def _getInitialConfig():
   data = {
     DEVICES_CONFIG_SECTION: {},
@@ -37,10 +62,47 @@ def _getInitialConfig():
   }
   return data
 
+def _statConfig():
+  try:
+    st = os.stat(CONFIG_FILE)
+  except FileNotFoundError:
+    return None
+
+  return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _buildIndexes():
+  global device_users
+  global device_policies
+  global generation
+
+  device_users = {}
+  device_policies = {}
+
+  for user, value in data[USERS_CONFIG_SECTION].items():
+    for mac in value["devices"]:
+      device_users[mac] = user
+
+  for mac, mac_info in data[DEVICES_CONFIG_SECTION].items():
+    policy = mac_info.get("policy", "default")
+
+    if (not policy) or (policy == "default"):
+      policy = getDefaultPolicy()
+
+    device_policies[mac] = policy
+
+  generation += 1
+
 def _loadData(force_reload = False):
   global data
+  global data_stat
 
   if not data or force_reload:
+    stat = _statConfig()
+
+    if data and (stat == data_stat):
+      # The file is unchanged
+      return data
+
     data = None
 
     try:
@@ -51,6 +113,8 @@ def _loadData(force_reload = False):
       else:
         raise
 
+    data_stat = stat
+
     macs_upper = {}
 
     for mac, mac_data in data[DEVICES_CONFIG_SECTION].items():
@@ -58,11 +122,18 @@ def _loadData(force_reload = False):
 
     data[DEVICES_CONFIG_SECTION] = macs_upper
     data[USERS_CONFIG_SECTION] = data.get(USERS_CONFIG_SECTION, {})
+    _buildIndexes()
   return data
 
 def _writeData(data):
+  global data_stat
+
   with open(CONFIG_FILE, 'w') as outfile:
     json.dump(data, outfile, indent=4, sort_keys=True, ensure_ascii=False)
+
+  # The in memory data is already up to date
+  data_stat = _statConfig()
+  _buildIndexes()
   return True
 
 # Returns True on success, False on failure
@@ -89,10 +160,8 @@ def _userAddDevice(user, mac):
     value["devices"].append(mac)
 
 def getDeviceUser(mac):
-  for user, value in data[USERS_CONFIG_SECTION].items():
-    if mac in value["devices"]:
-      return user
-  return None
+  _loadData()
+  return device_users.get(mac)
 
 def addDevice(mac, custom_name, ping_device, user, trigger_activity, policy, overwrite=False):
   data = _loadData()
@@ -192,6 +261,44 @@ def getCaptivePortalEnabled():
   data = _loadData()
   return data[GLOBAL_CONFG_SECTION].get("captive_portal", False)
 
+# Policy of the devices without a specific policy
+def getDefaultPolicy():
+  if getCaptivePortalEnabled():
+    return "captive_portal"
+
+  return "pass"
+
+# Returns: captive_portal|pass|block|capture
+def getDevicePolicy(mac):
+  _loadData()
+  policy = device_policies.get(mac)
+
+  if not policy:
+    policy = getDefaultPolicy()
+
+  return policy
+
+# Returns the mac -> policy dict of the configured devices
+def getDevicePolicies():
+  _loadData()
+  return device_policies
+
+def getGeneration():
+  _loadData()
+  return generation
+
+# Returns the seconds after which an idle captive portal authorization expires
+def getCaptivePortalSessionTime():
+  data = _loadData()
+  return int(data[GLOBAL_CONFG_SECTION].get("captive_portal_session", DEFAULT_CAPTIVE_PORTAL_SESSION_SEC))
+
+# Returns a resolution -> days dict
+def getRetentionDays():
+  data = _loadData()
+  retention = dict(DEFAULT_RETENTION_DAYS)
+  retention.update(data[GLOBAL_CONFG_SECTION].get("retention", {}))
+  return retention
+
 def getDeviceProbeEnabled(mac):
   # TODO remove active probe pref?
   return True
@@ -201,5 +308,39 @@ def getDeviceProbeEnabled(mac):
   #except KeyError:
     #return False
 
+# Reload the configuration if the file was modified
 def reload():
   _loadData(True)
+
+if __name__ == "__main__":
+  import tempfile
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    CONFIG_FILE = os.path.join(tmpdir, "config.json")
+    assert(getDevicePolicy("AA:BB:CC:DD:EE:FF") == "pass")
+    gen = getGeneration()
+
+    addUser("user", "avatar", None)
+    addDevice("aa:bb:cc:dd:ee:ff", "phone", False, "user", True, "block")
+    addDevice("11:22:33:44:55:66", "pc", False, None, True, "default")
+    updateSettings(True, True)
+    assert(getGeneration() > gen)
+    assert(getDeviceUser("AA:BB:CC:DD:EE:FF") == "user")
+    assert(getDeviceUser("11:22:33:44:55:66") == None)
+    assert(getDevicePolicy("AA:BB:CC:DD:EE:FF") == "block")
+    assert(getDevicePolicy("11:22:33:44:55:66") == "captive_portal")
+    assert(getDevicePolicy("22:22:33:44:55:66") == "captive_portal")
+
+    # Unchanged files are not parsed again
+    gen = getGeneration()
+    loaded = data
+    reload()
+    assert((data is loaded) and (getGeneration() == gen))
+
+    with open(CONFIG_FILE, "w") as f:
+      json.dump({DEVICES_CONFIG_SECTION: {}, USERS_CONFIG_SECTION: {}, GLOBAL_CONFG_SECTION: {}}, f)
+
+    reload()
+    assert(getGeneration() > gen)
+    assert(getDeviceUser("AA:BB:CC:DD:EE:FF") == None)
+    assert(getDevicePolicy("AA:BB:CC:DD:EE:FF") == "pass")
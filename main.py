@@ -26,11 +26,14 @@ import errno
 import subprocess
 import re
 import pickle
+import tempfile
 import config
 from queue import Empty as QueueEmpty
-from multiprocessing import Pipe, Event
+from multiprocessing import Pipe
+from message import ReplayEnd
 
 TIME_SLOT = 60
+REPLAY_TIME_SLOT = 1
 REMAINING_BEFORE_POKE = 20
 MESSAGE_CHECK_INTERVAL = 1
 MAX_CHECK_BEFORE_FORCED_KILL = 10
@@ -48,6 +51,10 @@ scanner_msgqueue = None
 web_msgqueue = None
 manager = None
 seen_hosts = {}
+seen_packets = 0
+replay_stats = None
+# The transport overflow counters at the last datapoint
+prev_transport_stats = {"overflows": 0, "names_overflows": 0}
 
 # ------------------------------------------------------------------------------
 
@@ -59,9 +66,10 @@ class HostInfo():
     self.last_seen = last_seen
     self.name = name
 
-  def update(self, last_seen, name=None):
+  def update(self, last_seen, name=None, ip=None):
     self.last_seen = last_seen
     if name: self.name = name
+    if ip and (ip != "0.0.0.0"): self.ip = ip
 
   def isBecomingIdle(self, now):
     return (not self.isIdle(now)) and ((now - self.last_seen) >= (TIME_SLOT - 10))
@@ -69,6 +77,43 @@ class HostInfo():
   def isIdle(self, now):
     return ((now - self.last_seen) >= config.MAX_HOST_IDLE_SEC)
 
+# Ingest path measurements of a pcap replay
+class ReplayStats():
+  def __init__(self):
+    self.num_packets = 0
+    self.duration = 0
+    self.queue_latencies = []
+    self.presence_delays = []
+    self.presence_reported = set()
+
+  def messageReceived(self, message, now):
+    self.queue_latencies.append(now - message.tstamp)
+
+  def datapointInserted(self, hosts, now):
+    for host in hosts:
+      if not host.mac in self.presence_reported:
+        self.presence_reported.add(host.mac)
+        self.presence_delays.append(now - host.first_seen)
+
+  def replayEnded(self, message):
+    self.num_packets = message.num_packets
+    self.duration = message.duration
+
+  def report(self):
+    def fmtDelays(delays):
+      if not delays:
+        return "n/a"
+
+      delays = sorted(delays)
+      return "avg %.1f ms, p50 %.1f ms, max %.1f ms" % (
+        sum(delays) * 1000 / len(delays), delays[len(delays) // 2] * 1000, delays[-1] * 1000)
+
+    pps = (self.num_packets / self.duration) if self.duration else 0
+
+    log.info("Replay: %d packets in %.2f s (%d packets/s)" % (self.num_packets, self.duration, pps))
+    log.info("Replay: queue latency (%d messages): %s" % (len(self.queue_latencies), fmtDelays(self.queue_latencies)))
+    log.info("Replay: time-to-presence (%d hosts): %s" % (len(self.presence_delays), fmtDelays(self.presence_delays)))
+
 class MessageParser():
   def __init__(self, msg):
     self.msg = msg
@@ -122,7 +167,7 @@ def handleHost(mac, ip, seen_tstamp, host_name):
 
   try:
     host = seen_hosts[mac]
-    host.update(seen_tstamp, host_name)
+    host.update(seen_tstamp, host_name, ip)
   except KeyError:
     host = HostInfo(mac, ip, seen_tstamp, host_name)
     log.info("[+]" + mac)
@@ -136,18 +181,40 @@ def insertHostsDataPoint(time_ref, now):
   global presence_db
   global meta_db
   global seen_hosts
+  global seen_packets
+  global prev_transport_stats
   active_devices = []
+  active_hosts = []
 
   for host in seen_hosts.values():
     if not host.isIdle(now):
       active_devices.append(host.mac)
-      meta_db.update(host.mac, int(host.last_seen), name=host.name, ip=host.ip)
+      active_hosts.append((host.mac, int(host.last_seen), host.name, host.ip))
+
+  log.debug("Insert datapoint: @" + str(time_ref) + ": " + str(len(active_devices)) + " devices, " + str(seen_packets) + " packets")
+  transport_stats = manager.getTransportStats()
 
-  log.debug("Insert datapoint: @" + str(time_ref) + ": " + str(len(active_devices)) + " devices")
+  if transport_stats:
+    # The counters only grow, only report the new overflows
+    overflows = transport_stats["overflows"] - prev_transport_stats["overflows"]
+    names_overflows = transport_stats["names_overflows"] - prev_transport_stats["names_overflows"]
+    prev_transport_stats = transport_stats
+
+    if overflows or names_overflows:
+      log.warning("Messages transport overflows: %d hosts, %d names" % (overflows, names_overflows))
+
+  seen_packets = 0
+  meta_db.updateMany(active_hosts)
   presence_db.insert(time_ref, active_devices)
 
+  if replay_stats:
+    replay_stats.datapointInserted([seen_hosts[mac] for mac in active_devices], time.time())
+
 def guessMainInterface():
-  output = subprocess.check_output(['ip', '-4', 'route', 'list', '0/0'])
+  try:
+    output = subprocess.check_output(['ip', '-4', 'route', 'list', '0/0'])
+  except (OSError, subprocess.CalledProcessError):
+    return ""
 
   if output:
     parts = output.decode("ascii").split()
@@ -161,19 +228,31 @@ def guessMainInterface():
 
   return ""
 
-def processDevicesUpdates():
+def processDevicesUpdates(timeout=0):
+  global running
+  global seen_packets
+
   # NOTE: devices updates are received when the jobs call self.msg_queue.put
+  # Each message is a batch of the hosts seen since the previous one
+  for message in manager.getMessages(timeout):
+    if replay_stats:
+      replay_stats.messageReceived(message, time.time())
+
+      if isinstance(message, ReplayEnd):
+        replay_stats.replayEnded(message)
+        running = False
 
-  for message in manager.getMessages():
-      handleHost(message.mac, message.ip, message.seen_tstamp, message.host_name)
+    for host in message:
+      handleHost(host.mac, host.ip, host.seen_tstamp, host.host_name)
+      seen_packets += host.count
 
-def mainLoop():
+def mainLoop(time_slot=TIME_SLOT):
   global running
   global seen_hosts
 
   now = int(time.time())
-  prev_slot = now - (now % TIME_SLOT)
-  next_slot = prev_slot + TIME_SLOT
+  prev_slot = now - (now % time_slot)
+  next_slot = prev_slot + time_slot
   poke_time = next_slot - REMAINING_BEFORE_POKE
   poke_started = False
 
@@ -190,8 +269,8 @@ def mainLoop():
             break
 
       insertHostsDataPoint(prev_slot, now)
-      prev_slot = now - (now % TIME_SLOT)
-      next_slot = prev_slot + TIME_SLOT
+      prev_slot = now - (now % time_slot)
+      next_slot = prev_slot + time_slot
       poke_time = next_slot - REMAINING_BEFORE_POKE
       poke_started = False
     elif not poke_started and now >= poke_time:
@@ -219,6 +298,11 @@ def mainLoop():
     if now < next_slot:
       seconds = min(next_slot, now + MESSAGE_CHECK_INTERVAL) - now
 
+      if not web_msgqueue:
+        # Sleep waiting for the devices updates
+        processDevicesUpdates(seconds)
+        continue
+
       # Sleep
       has_msg = web_msgqueue[1].poll(timeout=seconds)
 
@@ -229,6 +313,52 @@ def mainLoop():
           processDevicesUpdates()
           web_msgqueue[1].send(pickle.dumps(seen_hosts))
 
+  if replay_stats:
+    # Account the hosts seen in the last slot
+    insertHostsDataPoint(prev_slot, int(time.time()))
+
+# Replay a capture file through the packets reader and the hosts accounting.
+# No privileges, network interface or nftables are needed, and the databases
+# are temporary.
+def runReplay(pcap_file, speed, transport):
+  global presence_db
+  global meta_db
+  global manager
+  global replay_stats
+
+  from utils.jobs import JobsManager, FdEvent
+  from packets_reader import PacketsReaderJob
+  from presence_db import PresenceDB
+  from meta_db import MetaDB
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    presence_db = PresenceDB(os.path.join(tmp_dir, "presence.db"))
+    meta_db = MetaDB(os.path.join(tmp_dir, "meta.db"))
+    replay_stats = ReplayStats()
+
+    manager = JobsManager({
+      "interface": "",
+      "replay_file": pcap_file,
+      "replay_speed": speed,
+    }, transport)
+
+    log.info("Replaying %s (speed: %s)..." % (pcap_file, speed))
+    manager.runJob(PacketsReaderJob(), (Pipe(), FdEvent(), True))
+    initSignals()
+
+    try:
+      mainLoop(REPLAY_TIME_SLOT)
+    except Exception as e:
+      log.exception("Unexpected error")
+
+    manager.terminate()
+
+    while manager.getRunning():
+      time.sleep(0.1)
+
+    replay_stats.report()
+    manager.close()
+
 def dropPrivileges(drop_user, drop_group):
   if os.getuid() != 0:
     print("You have not root privileges")
@@ -251,9 +381,17 @@ if __name__ == "__main__":
   parser.add_argument('-u', dest="user", default="root", help='user:group to drop privileges to (default: do not drop privileges)')
   parser.add_argument('-i', dest="interface", default=network_interface, help='network interface to monitor (default: ' + network_interface + ')')
   parser.add_argument('-p', dest="passive", action='store_true', default=False, help="run in passive mode (do not send probes)")
+  parser.add_argument('--ring', dest="ring", action='store_true', default=False, help="capture with a TPACKET_V3 mmap ring in place of libpcap (Linux only)")
+  parser.add_argument('--transport', dest="transport", choices=["queue", "shm"], default="queue", help="transport of the devices updates from the packets reader (default: queue)")
+  parser.add_argument('--replay', dest="replay", metavar="FILE", help="replay a pcap file to benchmark the packets processing, then exit")
+  parser.add_argument('--speed', dest="speed", choices=["max", "realtime"], default="max", help="replay speed (default: max)")
 
   args = parser.parse_args(sys.argv[1:])
 
+  if args.replay:
+    runReplay(args.replay, args.speed, args.transport)
+    exit(0)
+
   if args.interface == "":
     log.error("Cannot determine main network interface, please specify the -i option")
     exit(1)
@@ -279,12 +417,13 @@ if __name__ == "__main__":
 
   log.debug("Loading modules...")
 
-  from utils.jobs import JobsManager
+  from utils.jobs import JobsManager, FdEvent
   from packets_reader import PacketsReaderJob
   from arp_scanner import ARPScannerJob
   from presence_db import PresenceDB
   from webserver import WebServerJob
   from captive_portal import CaptivePortalJob
+  from retention import RetentionJob
   from meta_db import MetaDB
 
   log.debug("Initializing database...")
@@ -294,11 +433,12 @@ if __name__ == "__main__":
   log.info("Starting startup jobs...")
   manager = JobsManager({
     "interface": args.interface,
-  })
+    "capture_ring": args.ring,
+  }, args.transport)
 
   log.debug("Starting packets reader...")
   cp_eventsqueue = Pipe()
-  config_changeev = Event()
+  config_changeev = FdEvent()
   manager.runJob(PacketsReaderJob(), (cp_eventsqueue, config_changeev, args.passive))
 
   if not args.passive:
@@ -308,6 +448,9 @@ if __name__ == "__main__":
   else:
     log.info("Ignoring ARP scanner in passive mode")
 
+  log.debug("Starting retention job...")
+  manager.runJob(RetentionJob())
+
   log.debug("Starting web server...")
   web_msgqueue = Pipe()
   manager.runJob(WebServerJob(), (web_msgqueue, config_changeev))
@@ -341,3 +484,5 @@ if __name__ == "__main__":
       log.error("Some jobs do not stop, killing them now!")
       manager.kill()
       break
+
+  manager.close()
@@ -16,12 +16,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import time
+
 class Message:
   def __init__(self, mac, ip, seen_tstamp):
     self.mac = mac
     self.ip = ip
     self.seen_tstamp = seen_tstamp
     self.host_name = None
+    # Number of packets this message represents
+    self.count = 1
     self._next = True
 
   def __iter__(self):
@@ -34,9 +38,23 @@ class Message:
     else:
       raise StopIteration()
 
+  __next__ = next
+
 class Messages:
   def __init__(self, messages):
     self.messages = messages
+    # To measure the queue latency
+    self.tstamp = time.time()
 
   def __iter__(self):
     return iter(self.messages)
+
+  def numPackets(self):
+    return sum([msg.count for msg in self.messages])
+
+# Sent by the packets reader when the replay of a capture file is over
+class ReplayEnd(Messages):
+  def __init__(self, num_packets, duration):
+    super(ReplayEnd, self).__init__([])
+    self.num_packets = num_packets
+    self.duration = duration
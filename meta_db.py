@@ -18,76 +18,192 @@
 #
 
 import sqlite3
-from utils.db import deviceToKey, keyToDevice, ip2long, long2ip
+import config
+from utils.db import deviceToId, idToDevice, ip2long, long2ip, migrateTables, initConnection, connectReadOnly
 
 META_DB = "data/meta.db"
+SCHEMA_VERSION = 2
+
+# Maximum number of devices looked up by a single query
+QUERY_MANY_CHUNK = 500
 
 class MetaDB():
-  def __init__(self):
-    self.conn = sqlite3.connect(META_DB)
+  # A readonly instance can only be used for queries
+  def __init__(self, db_path=META_DB, readonly=False):
+    self.conn = connectReadOnly(db_path) if readonly else sqlite3.connect(db_path)
     self.cursor = self.conn.cursor()
-    self._initTable()
+    self.open_leases = {}
+
+    if not readonly:
+      initConnection(self.conn)
+      self._initTable()
+
+  def _createTables(self):
+    self.cursor.execute("""CREATE TABLE IF NOT EXISTS meta (mac INTEGER NOT NULL, last_seen INTEGER NOT NULL, last_ip INTEGER, name TEXT, PRIMARY KEY (mac))""")
+
+    # IP to MAC history: a row for each period an IP address was used by a device
+    self.cursor.execute("""CREATE TABLE IF NOT EXISTS ip_history (ip INTEGER NOT NULL, mac INTEGER NOT NULL, first_seen INTEGER NOT NULL, last_seen INTEGER NOT NULL, PRIMARY KEY (ip, first_seen)) WITHOUT ROWID""")
+    self.cursor.execute("""CREATE INDEX IF NOT EXISTS idx_ip_history_mac_first_seen ON ip_history (mac, first_seen)""")
 
   def _initTable(self):
-    self.cursor.execute("""CREATE TABLE IF NOT EXISTS meta (mac CHARACTER(12) NOT NULL, last_seen INTEGER NOT NULL, last_ip INTEGER, name TEXT, PRIMARY KEY (mac))""")
+    version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+
+    if version < 1:
+      # MAC addresses were stored as 12 characters strings
+      self.conn.create_function("key_to_id", 1, lambda key: int(key, 16))
+      migrateTables(self.cursor, self._createTables, {"mac": "key_to_id(mac)"})
+    else:
+      self._createTables()
+
+    if version != SCHEMA_VERSION:
+      self.cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
     self.conn.commit()
 
-  def update(self, mac, tstamp, name=None, ip=None):
-    device_key = deviceToKey(mac)
+  # Extend the current lease of the IP addresses, or start a new one when the
+  # address is now used by a different device
+  def _updateIpHistory(self, leases):
+    extended = []
+    opened = []
 
-    # first insert minimal info
-    q = "INSERT INTO meta (mac, last_seen) SELECT ?, 0 WHERE NOT EXISTS(SELECT 1 FROM meta WHERE mac = ?) "
-    params = [device_key, device_key]
-    # print(q, params)
-    self.cursor.execute(q, params)
+    for ip, device_id, tstamp in leases:
+      lease = self.open_leases.get(ip)
+
+      if not lease:
+        lease = self.cursor.execute("SELECT mac, first_seen FROM ip_history WHERE ip = ? ORDER BY first_seen DESC LIMIT 1", (ip,)).fetchone()
+
+      if lease and (lease[0] == device_id):
+        extended.append((tstamp, ip, lease[1]))
+      elif (not lease) or (lease[1] < tstamp):
+        opened.append((ip, device_id, tstamp, tstamp))
+        lease = (device_id, tstamp)
 
-    # actual update
-    fields = ["last_seen = ?"]
-    values = [tstamp]
+      self.open_leases[ip] = lease
 
-    if ip:
-      fields.append("last_ip = ?")
-      values.append(ip2long(ip))
+    self.cursor.executemany("UPDATE ip_history SET last_seen = max(last_seen, ?) WHERE ip = ? AND first_seen = ?", extended)
+    self.cursor.executemany("INSERT INTO ip_history (ip, mac, first_seen, last_seen) VALUES (?,?,?,?)", opened)
 
-    if name:
-      fields.append("name = ?")
-      values.append(name)
+  # Update multiple devices in a single transaction.
+  # hosts is a list of (mac, tstamp, name, ip), name and ip are optional
+  def updateMany(self, hosts):
+    q = "INSERT INTO meta (mac, last_seen, last_ip, name) VALUES (?,?,?,?) ON CONFLICT (mac) DO UPDATE SET" \
+      " last_seen = excluded.last_seen, last_ip = coalesce(excluded.last_ip, last_ip), name = coalesce(excluded.name, name)"
+    params = []
+    leases = []
 
-    q = "UPDATE meta SET " + ", ".join(fields) + " WHERE mac = ?"
-    values.append(device_key)
-    # print(q, values)
+    for mac, tstamp, name, ip in hosts:
+      ip = ip2long(ip) if (ip and (ip != "0.0.0.0")) else None
+      params.append((deviceToId(mac), tstamp, ip, name or None))
 
-    self.cursor.execute(q, values)
+      if ip is not None:
+        leases.append((ip, deviceToId(mac), tstamp))
+
+    self.cursor.executemany(q, params)
+    self._updateIpHistory(leases)
     self.conn.commit()
 
+  def update(self, mac, tstamp, name=None, ip=None):
+    self.updateMany([(mac, tstamp, name, ip)])
+
+  def _rowToMetadata(self, row):
+    return {
+      "mac": idToDevice(row[0]),
+      "last_seen": int(row[1]),
+      "last_ip": long2ip(row[2]),
+      "name": row[3],
+    }
+
   def query(self, mac):
     q = "SELECT * FROM meta WHERE mac = ?"
-    params = [deviceToKey(mac), ]
+    params = [deviceToId(mac), ]
     # print(q, params)
     res = self.cursor.execute(q, params).fetchall()
 
     if not res or len(res) != 1:
       return None
 
-    res = res[0]
+    return self._rowToMetadata(res[0])
 
-    return {
-      "mac": keyToDevice(res[0]),
-      "last_seen": int(res[1]),
-      "last_ip": long2ip(res[2]),
-      "name": res[3],
-    }
+  # Returns a mac -> metadata dict for the given macs, skipping the unknown ones.
+  # The dict keys are the macs as passed in.
+  def queryMany(self, macs):
+    macs_by_id = dict([(deviceToId(mac), mac) for mac in macs])
+    device_ids = list(macs_by_id.keys())
+    rv = {}
+
+    for i in range(0, len(device_ids), QUERY_MANY_CHUNK):
+      chunk = device_ids[i:i+QUERY_MANY_CHUNK]
+      q = "SELECT * FROM meta WHERE mac IN (" + ",".join(["?"] * len(chunk)) + ")"
+
+      for row in self.cursor.execute(q, chunk):
+        rv[macs_by_id[row[0]]] = self._rowToMetadata(row)
+
+    return rv
+
+  # Returns the MAC of the device which was using the IP address at tstamp
+  # (now if not specified), or None. A lease covers tstamp until the device
+  # becomes idle, as the sightings are only stored periodically.
+  def ipToMac(self, ip, tstamp=None):
+    q = "SELECT mac FROM ip_history WHERE ip = ?"
+    params = [ip2long(ip)]
+
+    if tstamp is not None:
+      q = q + " AND first_seen <= ? AND last_seen >= ?"
+      params += [tstamp, tstamp - config.MAX_HOST_IDLE_SEC]
+
+    res = self.cursor.execute(q + " ORDER BY first_seen DESC LIMIT 1", params).fetchone()
+    return idToDevice(res[0]) if res else None
+
+  # Returns the IP address used by the device at tstamp (now if not specified),
+  # or None
+  def macToIp(self, mac, tstamp=None):
+    q = "SELECT ip FROM ip_history WHERE mac = ?"
+    params = [deviceToId(mac)]
+
+    if tstamp is not None:
+      q = q + " AND first_seen <= ? AND last_seen >= ?"
+      params += [tstamp, tstamp - config.MAX_HOST_IDLE_SEC]
+
+    res = self.cursor.execute(q + " ORDER BY first_seen DESC LIMIT 1", params).fetchone()
+    return long2ip(res[0]) if res else None
+
+  # Returns an ip -> mac dict of the IP addresses used since the given time
+  def ipToMacMap(self, since):
+    rv = {}
+
+    # Newer leases replace the older ones
+    for ip, device_id in self.cursor.execute("SELECT ip, mac FROM ip_history WHERE last_seen >= ? ORDER BY first_seen", (since,)):
+      rv[long2ip(ip)] = idToDevice(device_id)
+
+    return rv
+
+  # Returns a mac -> metadata dict of all the devices
+  def all(self):
+    rv = {}
+
+    for row in self.cursor.execute("SELECT * FROM meta"):
+      metadata = self._rowToMetadata(row)
+      rv[metadata["mac"]] = metadata
+
+    return rv
 
 if __name__ == "__main__":
-  import time
+  import os, tempfile, time
   tstamp = int(time.time())
 
-  meta = MetaDB()
+  tmpdir = tempfile.TemporaryDirectory()
+  meta = MetaDB(os.path.join(tmpdir.name, "meta.db"))
   meta.update("11:22:33:44:55:66", tstamp, name="Checco")
   meta.update("11:22:33:44:55:66", tstamp)
   meta.update("11:22:33:44:55:66", tstamp, ip="192.168.1.1")
   meta.update("22:22:33:44:55:66", tstamp)
 
+  meta.updateMany([("22:22:33:44:55:66", tstamp - 10, None, None), ("33:22:33:44:55:66", tstamp, "Bulk", "192.168.1.3")])
+  meta.updateMany([("22:22:33:44:55:66", tstamp, None, None), ("33:22:33:44:55:66", tstamp, None, None)])
+
+  res = meta.query("33:22:33:44:55:66")
+  assert(res["name"] == "Bulk")
+  assert(res["last_ip"] == "192.168.1.3")
   res = meta.query("22:22:33:44:55:66")
   assert(res["name"] == None)
   assert(res["last_seen"] == tstamp)
@@ -95,3 +211,56 @@ if __name__ == "__main__":
   assert(res["mac"] == "11:22:33:44:55:66")
   assert(res["name"] == "Checco")
   assert(res["last_ip"] == "192.168.1.1")
+
+  res = meta.queryMany(["11:22:33:44:55:66", "33:22:33:44:55:66", "ff:22:33:44:55:66"])
+  assert(sorted(res.keys()) == ["11:22:33:44:55:66", "33:22:33:44:55:66"])
+  assert(res["11:22:33:44:55:66"] == meta.query("11:22:33:44:55:66"))
+  assert(res["33:22:33:44:55:66"]["name"] == "Bulk")
+  assert(meta.queryMany([]) == {})
+  assert(len(meta.queryMany(["%012x" % i for i in range(0x112233445566 - 1000, 0x112233445566 + 1000)])) == 1)
+  assert(meta.all() == dict([(mac, meta.query(mac)) for mac in ["11:22:33:44:55:66", "22:22:33:44:55:66", "33:22:33:44:55:66"]]))
+
+  # IP addresses history
+  meta.updateMany([("11:22:33:44:55:66", tstamp + 60, None, "192.168.1.1"), ("44:22:33:44:55:66", tstamp + 60, None, "0.0.0.0")])
+  meta.updateMany([("33:22:33:44:55:66", tstamp + 120, None, "192.168.1.1"), ("11:22:33:44:55:66", tstamp + 120, None, "192.168.1.2")])
+  meta.updateMany([("33:22:33:44:55:66", tstamp + 180, None, "192.168.1.1")])
+  assert(meta.cursor.execute("SELECT count(*) FROM ip_history").fetchone()[0] == 4)
+  assert(meta.ipToMac("192.168.1.1", tstamp + 60) == "11:22:33:44:55:66")
+  assert(meta.ipToMac("192.168.1.1", tstamp + 150) == "33:22:33:44:55:66")
+  assert(meta.ipToMac("192.168.1.1") == "33:22:33:44:55:66")
+  assert(meta.ipToMac("192.168.1.1", tstamp - 1) == None)
+  assert(meta.ipToMac("0.0.0.0") == None)
+  assert(meta.macToIp("11:22:33:44:55:66", tstamp + 60) == "192.168.1.1")
+  assert(meta.macToIp("11:22:33:44:55:66") == "192.168.1.2")
+  assert(meta.ipToMacMap(tstamp + 120) == {"192.168.1.1": "33:22:33:44:55:66", "192.168.1.2": "11:22:33:44:55:66"})
+
+  # Expired leases
+  meta.updateMany([("55:22:33:44:55:66", tstamp, None, "192.168.1.57")])
+  assert(meta.ipToMac("192.168.1.57", tstamp + config.MAX_HOST_IDLE_SEC) == "55:22:33:44:55:66")
+  assert(meta.ipToMac("192.168.1.57", tstamp + 7 * 86400) == None)
+  assert(meta.macToIp("55:22:33:44:55:66", tstamp + 7 * 86400) == None)
+
+  # Reused IP address, with a gap between the leases
+  meta.updateMany([("66:22:33:44:55:66", tstamp + 3600, None, "192.168.1.57")])
+  assert(meta.ipToMac("192.168.1.57", tstamp + 60) == "55:22:33:44:55:66")
+  assert(meta.ipToMac("192.168.1.57", tstamp + 1800) == None)
+  assert(meta.ipToMac("192.168.1.57", tstamp + 3600) == "66:22:33:44:55:66")
+  assert(meta.macToIp("55:22:33:44:55:66", tstamp + 3600) == None)
+
+  # The leases are extended after a restart
+  meta = MetaDB(os.path.join(tmpdir.name, "meta.db"))
+  meta.updateMany([("33:22:33:44:55:66", tstamp + 240, None, "192.168.1.1")])
+  assert(meta.cursor.execute("SELECT first_seen, last_seen FROM ip_history WHERE ip = ? ORDER BY first_seen DESC", (ip2long("192.168.1.1"),)).fetchone() == (tstamp + 120, tstamp + 240))
+
+  # Databases created by older versions are migrated on open
+  legacy_path = os.path.join(tmpdir.name, "legacy.db")
+  conn = sqlite3.connect(legacy_path)
+  conn.execute("CREATE TABLE meta (mac CHARACTER(12) NOT NULL, last_seen INTEGER NOT NULL, last_ip INTEGER, name TEXT, PRIMARY KEY (mac))")
+  conn.execute("INSERT INTO meta VALUES ('AABBCCDDEEFF', ?, ?, 'Legacy')", (tstamp, ip2long("192.168.1.2")))
+  conn.commit()
+  conn.close()
+
+  meta = MetaDB(legacy_path)
+  res = meta.query("aa:bb:cc:dd:ee:ff")
+  assert(res["name"] == "Legacy")
+  assert(res["last_ip"] == "192.168.1.2")
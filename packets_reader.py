@@ -19,46 +19,223 @@
 
 import time
 import os
+import heapq
+import itertools
+import selectors
+from collections import OrderedDict
 
 from utils.jobs import Job
 from utils.privs import acquire_capabilities
-from utils.data import getDevicePolicy
+from meta_db import MetaDB
 import c_modules.pkt_reader as pkt_reader
 import c_modules.nft as nft
 import config
 
-from message import Message
+from message import Message, Messages, ReplayEnd
 
-SNIFF_TIMEOUT = 1
+READ_BATCH_SIZE = 64
 SPOOFING_TIMEOUT = 0.5
 SPOOFED_MAC_IDLE_TIMEOUT = 300
 
+# The hosts sightings are coalesced and sent to the main process at most once
+# per interval, unless a new host or an IP/name change is seen
+HOSTS_FLUSH_INTERVAL = 1
+
+# Policies which require the device to be spoofed
+SPOOF_POLICIES = frozenset(["block", "captive_portal", "capture"])
+
+# On startup, the IP to MAC mappings seen within this time are loaded from the IP history
+IP_TO_MAC_WARMUP_SEC = 86400
+
+# The verdict of the configured devices in the cp_policy map of each table.
+# Whitelisted devices are not redirected to the captive portal and are
+# forwarded, blacklisted devices are not redirected but their traffic is dropped.
+NFT_VERDICTS = {
+  "nat": {"whitelisted": "accept", "blacklisted": "accept"},
+  "filter": {"whitelisted": "accept", "blacklisted": "drop"},
+}
+
+# The chains holding the netwatch rules
+NFT_CHAINS = (("nat", "nw_prerouting"), ("nat", "nw_postrouting"), ("filter", "nw_forward"))
+
+# Returns the commands to bring the cp_policy maps from the current to the
+# wanted {mac: "whitelisted"|"blacklisted"} elements
+def nftPolicyDelta(current, wanted):
+  cmds = []
+  removed = sorted([mac for mac, cls in current.items() if wanted.get(mac) != cls])
+  added = sorted([mac for mac, cls in wanted.items() if current.get(mac) != cls])
+
+  for table, verdicts in NFT_VERDICTS.items():
+    # Changed elements are removed first, then added with the new verdict
+    if removed:
+      cmds.append("delete element ip %s cp_policy { %s }" % (table, ", ".join(removed)))
+    if added:
+      cmds.append("add element ip %s cp_policy { %s }" % (table,
+        ", ".join(["%s : %s" % (mac, verdicts[wanted[mac]]) for mac in added])))
+
+  return cmds
+
+# Schedules the spoofed ARP requests: each target is sent its prebuilt frame
+# every SPOOFING_TIMEOUT seconds, until it is idle for SPOOFED_MAC_IDLE_TIMEOUT.
+# Targets are kept into a heap by next send time. Removed or replaced targets
+# leave stale heap entries, which are skipped.
+class SpoofScheduler():
+  def __init__(self, make_frame):
+    self.make_frame = make_frame
+    self.targets = {}
+    self.heap = []
+    self.seq = itertools.count()
+
+  def spoof(self, mac, ip, now):
+    target = self.targets.get(mac)
+
+    if target and (target["ip"] == ip):
+      target["last_seen"] = now
+      return
+
+    target = {"last_seen": now, "ip": ip, "frame": self.make_frame(mac, ip), "seq": next(self.seq)}
+    self.targets[mac] = target
+    heapq.heappush(self.heap, (now, target["seq"], mac))
+
+  def get(self, mac):
+    return self.targets.get(mac)
+
+  def pop(self, mac, default=None):
+    return self.targets.pop(mac, default)
+
+  def items(self):
+    return self.targets.items()
+
+  # Returns the time of the next send, None if there are no targets. May be
+  # earlier than the actual one, when the first heap entry is stale.
+  def nextDeadline(self):
+    return self.heap[0][0] if self.heap else None
+
+  # Returns the frames to send at now, rescheduling their targets
+  def dueFrames(self, now):
+    frames = []
+
+    while self.heap and (self.heap[0][0] <= now):
+      _, seq, mac = heapq.heappop(self.heap)
+      target = self.targets.get(mac)
+
+      if (not target) or (target["seq"] != seq):
+        continue
+
+      if (now - target["last_seen"]) >= SPOOFED_MAC_IDLE_TIMEOUT:
+        del self.targets[mac]
+        continue
+
+      frames.append(target["frame"])
+      target["seq"] = next(self.seq)
+      heapq.heappush(self.heap, (now + SPOOFING_TIMEOUT, target["seq"], mac))
+
+    return frames
+
 class PacketsReaderJob(Job):
   def __init__(self):
     super(PacketsReaderJob, self).__init__("PacketsReaderJob", self.task)
     self.cp_eventsqueue = None
-    self.whitelisted_devices = {}
+    # mac -> last activity of the devices authenticated via the captive
+    # portal, oldest first
+    self.whitelisted_devices = OrderedDict()
+    self.cp_session_time = config.DEFAULT_CAPTIVE_PORTAL_SESSION_SEC
+    self.policies = {}
+    self.default_policy = "pass"
+    self.pending_hosts = {}
+    # mac -> (ip, name) last sent to the main process, kept across the flushes
+    self.sent_hosts = {}
+    self.hosts_changed = False
+    self.last_hosts_flush = 0
+    # The current elements of the nftables cp_policy maps
+    self.nft_policy = {}
+    # The session time of the nftables rules, None if not set up
+    self.nft_session_time = None
+    self.captive_port = None
 
   def handleHost(self, host_mac, host_ip, host_name, now):
     if host_mac != "00:00:00:00:00:00":
-      # TODO handle queue full
-      msg = Message(host_mac, host_ip, now)
-      if host_name:
+      msg = self.pending_hosts.get(host_mac)
+      changed = False
+
+      if not msg:
+        msg = Message(host_mac, host_ip, now)
+        msg.count = 0
+        self.pending_hosts[host_mac] = msg
+        changed = True
+      elif msg.ip != host_ip:
+        msg.ip = host_ip
+        changed = True
+
+      if host_name and (host_name != msg.host_name):
         msg.host_name = host_name
-      self.msg_queue.put(msg)
+        changed = True
 
-  def shouldSpoof(self, mac, ip):
-    if (not self.passive_mode) and (mac != self.gateway_mac) and \
-        (mac != self.iface_mac) and (mac != "00:00:00:00:00:00") and \
-        (ip != "0.0.0.0") and (not self.whitelisted_devices.get(mac)):
+      if changed and (not self.hosts_changed):
+        # Only new hosts and IP/name changes are sent immediately
+        sent = self.sent_hosts.get(host_mac)
+
+        self.hosts_changed = (sent is None) or (sent[0] != msg.ip) or \
+          (msg.host_name and (msg.host_name != sent[1]))
+
+      msg.seen_tstamp = now
+      msg.count += 1
+
+  # Send the coalesced sightings to the main process
+  def flushHosts(self, now, force=False):
+    if self.pending_hosts and (force or self.hosts_changed or ((now - self.last_hosts_flush) >= HOSTS_FLUSH_INTERVAL)):
+      # TODO handle queue full
+      self.msg_queue.put(Messages(list(self.pending_hosts.values())))
+
+      for mac, msg in self.pending_hosts.items():
+        sent = self.sent_hosts.get(mac)
+        self.sent_hosts[mac] = (msg.ip, msg.host_name or (sent and sent[1]))
+
+      self.pending_hosts = {}
+      self.hosts_changed = False
+      self.last_hosts_flush = now
+
+  # Build the mac -> policy map used while processing the packets. It must be
+  # called again when the configuration changes.
+  def compilePolicies(self):
+    self.policies = dict(config.getDevicePolicies())
+    self.default_policy = config.getDefaultPolicy()
+    self.cp_session_time = config.getCaptivePortalSessionTime()
+
+  def getPolicy(self, mac):
+    return self.policies.get(mac, self.default_policy)
 
-      policy = getDevicePolicy(mac)
+  # Whitelist the device, or refresh it on activity. Returns False if its
+  # captive portal session has expired.
+  def refreshWhitelisted(self, mac, now, add=False):
+    last_seen = self.whitelisted_devices.get(mac)
 
-      if(policy == "block") or (policy == "captive_portal") or (policy == "capture"):
-        print("Policy [MAC: %s] -> %s" % (mac, policy))
-        return True
+    if (last_seen is not None) and ((now - last_seen) >= self.cp_session_time):
+      del self.whitelisted_devices[mac]
+      last_seen = None
 
-    return False
+    if (last_seen is None) and (not add):
+      return False
+
+    self.whitelisted_devices[mac] = now
+    self.whitelisted_devices.move_to_end(mac)
+    return True
+
+  # Forget the devices idle for more than the session time
+  def expireWhitelisted(self, now):
+    while self.whitelisted_devices:
+      mac, last_seen = next(iter(self.whitelisted_devices.items()))
+
+      if (now - last_seen) < self.cp_session_time:
+        break
+
+      del self.whitelisted_devices[mac]
+
+  def shouldSpoof(self, mac, ip):
+    return (not self.passive_mode) and (mac != self.gateway_mac) and \
+      (mac != self.iface_mac) and (mac != "00:00:00:00:00:00") and \
+      (ip != "0.0.0.0") and (not mac in self.whitelisted_devices) and \
+      (self.policies.get(mac, self.default_policy) in SPOOF_POLICIES)
 
   def setForwarding(self, enabled):
     if self.passive_mode:
@@ -69,64 +246,114 @@ class PacketsReaderJob(Job):
     with open("/proc/sys/net/ipv4/ip_forward", 'w') as f:
       f.write('1' if enabled else '0')
 
-  def initNftables(self):
-    nft.run("add table ip nat")
-    nft.run("add table ip filter")
+  def initNftablesCommands(self):
+    cmds = [
+      "add table ip nat",
+      "add table ip filter",
+
+      # Chains are marked with the "nw_" prefix to identify them
+      "add chain ip nat nw_prerouting { type nat hook prerouting priority -100; }",
+      "add chain ip nat nw_postrouting { type nat hook postrouting priority -100; }",
+      "add chain ip filter nw_forward { type filter hook forward priority 0; }",
+    ]
+
+    # Rules may be left from a previous run
+    for table, chain in NFT_CHAINS:
+      cmds.append("flush chain ip %s %s" % (table, chain))
+
+    for table in NFT_VERDICTS:
+      # The authorizations expire in the kernel
+      cmds.append("add set ip %s cp_auth_ok { type ipv4_addr; flags dynamic, timeout; timeout %ds;}" % (table, self.cp_session_time))
+      cmds.append("add map ip %s cp_policy { type ether_addr : verdict;}" % (table,))
+      # Elements may be left from a previous run
+      cmds.append("flush map ip %s cp_policy" % (table,))
+
+    return cmds
+
+  # The configured devices are matched with a single cp_policy map lookup.
+  # The other devices are redirected to the captive portal, and their new
+  # connections are dropped, until they pass the captive portal auth.
+  # NOTE: cp_auth_ok is keyed by IP as the captive_portal does not know MAC addresses
+  def captiveRulesCommands(self, captive_port):
+    interface = self.options["interface"]
+
+    # The new connections of the authorized devices refresh their authorization.
+    # The timeout is explicit, as the set default one cannot be changed when
+    # the session time changes.
+    return [
+      "add rule nat nw_prerouting ether saddr vmap @cp_policy",
+      "add rule nat nw_prerouting ip saddr @cp_auth_ok update @cp_auth_ok { ip saddr timeout %ds } accept" % (self.cp_session_time,),
+      "add rule nat nw_prerouting iif %s tcp dport { 80 } ip saddr %s counter dnat %s:%d" % (
+        interface, self.lan_network, self.iface_ip, captive_port),
+
+      # Masquerade outgoing traffic
+      "add rule nat nw_postrouting oif %s ip saddr %s counter masquerade" % (interface, self.lan_network),
+
+      "add rule filter nw_forward ether saddr vmap @cp_policy",
+      # Only allow DNS traffic to pass (otherwise captive portal detection on the device won't work)
+      "add rule filter nw_forward iif %s ip saddr %s udp dport { 53 } counter accept" % (interface, self.lan_network),
+      "add rule filter nw_forward iif %s ct state new ip saddr @cp_auth_ok update @cp_auth_ok { ip saddr timeout %ds } counter accept" % (interface, self.cp_session_time),
+      "add rule filter nw_forward iif %s ct state new ip saddr %s counter drop" % (interface, self.lan_network),
+    ]
 
-    # Chains are marked with the "nw_" prefix to identify them
-    nft.run("add chain ip nat nw_prerouting { type nat hook prerouting priority -100; }")
-    nft.run("add chain ip nat nw_postrouting { type nat hook postrouting priority -100; }")
-    nft.run("add chain ip filter nw_forward { type filter hook forward priority 0; }")
+  def termNftables(self):
+    # NOTE: don't delete tables as rules from other programs may be present
+    cmds = []
 
-    nft.run("add set ip nat cp_auth_ok { type ipv4_addr;}")
-    nft.run("add set ip nat cp_whitelisted { type ether_addr;}")
-    nft.run("add set ip nat cp_blacklisted { type ether_addr;}")
+    for table, chain in NFT_CHAINS:
+      cmds.append("flush chain ip %s %s" % (table, chain))
+      cmds.append("delete chain ip %s %s" % (table, chain))
 
-    nft.run("add set ip filter cp_auth_ok { type ipv4_addr;}")
-    nft.run("add set ip filter cp_whitelisted { type ether_addr;}")
-    nft.run("add set ip filter cp_blacklisted { type ether_addr;}")
+    for table in NFT_VERDICTS:
+      cmds.append("delete set ip %s cp_auth_ok" % (table,))
+      cmds.append("delete map ip %s cp_policy" % (table,))
 
-  def termNftables(self):
-    # NOTE: don't delete tables as rules from other programs may be present
-    nft.run("delete chain ip nat nw_prerouting")
-    nft.run("delete chain ip nat nw_postrouting")
-    nft.run("delete chain ip filter nw_forward")
+    if not nft.run_batch(cmds):
+      # Some objects are missing, delete the others one by one
+      for cmd in cmds:
+        nft.run(cmd)
+
+    self.nft_policy = {}
 
-    nft.run("delete set ip nat cp_auth_ok")
-    nft.run("delete set ip nat cp_whitelisted")
-    nft.run("delete set ip nat cp_blacklisted")
+  # Rebuild the rules when the captive portal session time changes
+  def reloadCaptiveRules(self):
+    if (self.nft_session_time is None) or (self.cp_session_time == self.nft_session_time):
+      return
+
+    cmds = ["flush chain ip %s %s" % (table, chain) for table, chain in NFT_CHAINS]
+    cmds += self.captiveRulesCommands(self.captive_port)
 
-    nft.run("delete set ip filter cp_auth_ok")
-    nft.run("delete set ip filter cp_whitelisted")
-    nft.run("delete set ip filter cp_blacklisted")
+    if nft.run_batch(cmds):
+      self.nft_session_time = self.cp_session_time
+    else:
+      print("Warning: could not update the nftables rules")
 
   def setupCaptiveNat(self):
     # TODO
     captive_port = 9000
+    self.captive_port = captive_port
     self.forwarding_was_enabled = False
 
     # Check if forwarding is enabled to restore it after program end
     with open("/proc/sys/net/ipv4/ip_forward", 'r') as f:
       self.forwarding_was_enabled = (f.read(1) == '1')
 
-    self.initNftables()
-
-    # Devices are classified into 3 sets:
+    # Devices are classified into:
     #  - cp_auth_ok: devices which have passed the captive portal auth
-    #  - cp_whitelisted: devices manually set as "pass" from the gui (or "capture")
-    #  - cp_blacklisted: devices manually set as "block" from the gui
-    # NOTE: Could use ether_addr sets with "ether saddr" match but the captive_portal
-    # does not know MAC addresses
-    nft.run("add rule nat nw_prerouting iif %s tcp dport { 80 } ip saddr %s ip saddr != @cp_auth_ok ether saddr != @cp_whitelisted ether saddr != @cp_blacklisted counter dnat %s:%d" % (
-      self.options["interface"], self.lan_network, self.iface_ip, captive_port))
+    #  - whitelisted: devices manually set as "pass" from the gui (or "capture")
+    #  - blacklisted: devices manually set as "block" from the gui
+    cmds = self.initNftablesCommands() + self.captiveRulesCommands(captive_port)
 
-    # Masquerade outgoing traffic
-    nft.run("add rule nat nw_postrouting oif %s ip saddr %s counter masquerade" % (self.options["interface"], self.lan_network))
+    # Tables, sets and rules are created in a single transaction
+    if not nft.run_batch(cmds):
+      # Objects left from a previous run may be incompatible, recreate them
+      self.termNftables()
 
-    # Only allow DNS traffic to pass (otherwise captive portal detection on the device won't work)
-    nft.run("add rule filter nw_forward ether saddr @cp_blacklisted counter drop")
-    nft.run("add rule filter nw_forward iif %s ip saddr %s udp dport { 53 } counter accept" % (self.options["interface"], self.lan_network))
-    nft.run("add rule filter nw_forward iif %s ct state new ip saddr %s ip saddr != @cp_auth_ok ether saddr != @cp_whitelisted counter drop" % (self.options["interface"], self.lan_network))
+      if not nft.run_batch(cmds):
+        print("Warning: could not setup the nftables rules")
+
+    self.nft_policy = {}
+    self.nft_session_time = self.cp_session_time
 
     if not self.forwarding_was_enabled:
       self.setForwarding(True)
@@ -135,13 +362,11 @@ class PacketsReaderJob(Job):
     if self.passive_mode:
       return
 
+    self.reloadCaptiveRules()
+
     devices = config.getConfiguredDevices()
     now = time.time()
-
-    nft.run("flush set ip filter cp_whitelisted")
-    nft.run("flush set ip filter cp_blacklisted")
-    nft.run("flush set ip nat cp_whitelisted")
-    nft.run("flush set ip nat cp_blacklisted")
+    wanted_policy = {}
 
     for mac, mac_info in devices.items():
       policy = mac_info.get("policy", "default")
@@ -149,19 +374,15 @@ class PacketsReaderJob(Job):
       spoof_mac = False
 
       if((policy == "pass") or (policy == "capture")):
-        nft.run("add element ip nat cp_whitelisted { %s }" % (mac,))
-        nft.run("add element ip filter cp_whitelisted { %s }" % (mac,))
+        wanted_policy[mac] = "whitelisted"
 
         if(policy == "pass"):
           rearp_mac = True
       elif policy == "block":
-        nft.run("add element ip nat cp_blacklisted { %s }" % (mac,))
-        nft.run("add element ip filter cp_blacklisted { %s }" % (mac,))
+        wanted_policy[mac] = "blacklisted"
         spoof_mac = True
       elif policy == "default":
-        applied_policy = getDevicePolicy(mac)
-
-        if applied_policy == "pass":
+        if self.getPolicy(mac) == "pass":
           rearp_mac = True
 
       if rearp_mac:
@@ -180,7 +401,63 @@ class PacketsReaderJob(Job):
             break
 
         if found_ip:
-          self.macs_to_spoof[mac] = {"last_seen": now, "ip": found_ip}
+          self.macs_to_spoof.spoof(mac, found_ip, now)
+
+    self.syncNftPolicy(wanted_policy)
+
+  # Only add and remove the changed elements of the cp_policy maps, in a single transaction
+  def syncNftPolicy(self, wanted_policy):
+    if nft.run_batch(nftPolicyDelta(self.nft_policy, wanted_policy)):
+      self.nft_policy = wanted_policy
+      return
+
+    # The maps are out of sync, replace their content atomically
+    cmds = ["flush map ip %s cp_policy" % (table,) for table in NFT_VERDICTS]
+    cmds += nftPolicyDelta({}, wanted_policy)
+
+    if nft.run_batch(cmds):
+      self.nft_policy = wanted_policy
+    else:
+      print("Warning: could not update the nftables policy maps")
+      self.nft_policy = {}
+
+  def handleCaptivePortalEvents(self):
+    while self.cp_eventsqueue[1].poll():
+      (msg_type, ip) = self.cp_eventsqueue[1].recv()
+
+      if(msg_type == "auth_ok"):
+        # A device was successfully authenticated
+        mac = self.ip_to_mac.get(ip)
+
+        if not mac:
+          print("Warning: unknown device with IP: " + ip)
+        else:
+          # Verify that the device has actually a captive_portal logic
+          if self.getPolicy(mac) == "captive_portal":
+            print("Whitelisting device [MAC=%s][IP=%s]" % (mac, ip))
+            self.refreshWhitelisted(mac, time.time(), add=True)
+
+            # Spoof the device back to the original gateway
+            pkt_reader.arp_rearp(self.handle, mac, ip)
+            self.macs_to_spoof.pop(mac, None)
+
+  def handlePackets(self, packets, now):
+    whitelisted_devices = self.whitelisted_devices
+
+    for mac, ip, proto, name, _, _ in packets:
+      self.handleHost(mac, ip, name, now)
+
+      if mac in whitelisted_devices:
+        self.refreshWhitelisted(mac, now)
+
+      if self.shouldSpoof(mac, ip):
+        if(proto == "ARP_REQ"):
+          # Immediately spoof the reply
+          pkt_reader.arp_rep_spoof(self.handle, mac, ip)
+
+        self.macs_to_spoof.spoof(mac, ip, now)
+
+      self.ip_to_mac[ip] = mac
 
   def termCaptiveNat(self):
     self.termNftables()
@@ -188,24 +465,77 @@ class PacketsReaderJob(Job):
     if not self.forwarding_was_enabled:
       self.setForwarding(False)
 
+  # Feed the packets of a capture file through the packets processing, as
+  # fast as possible ("max" speed) or at their original pace ("realtime").
+  # Nothing is sent on the network, so no privileges are needed.
+  def replay(self, pcap_file, speed):
+    self.passive_mode = True
+    self.gateway_mac = self.iface_mac = None
+    self.ip_to_mac = {}
+    self.compilePolicies()
+
+    handle = pkt_reader.open_capture_file(pcap_file, "broadcast or arp")
+    self.handle = handle
+    self.macs_to_spoof = SpoofScheduler(None)
+
+    # Packets are paced one at a time in realtime
+    batch_size = 1 if (speed == "realtime") else READ_BATCH_SIZE
+    start = time.time()
+    first_packet = None
+    num_packets = 0
+
+    while self.isRunning():
+      packets = pkt_reader.read_packets(handle, batch_size, 0)
+
+      if packets is None:
+        break
+
+      now = time.time()
+
+      if packets and (speed == "realtime"):
+        if first_packet is None:
+          first_packet = packets[0][5]
+
+        delay = (packets[0][5] - first_packet) - (now - start)
+
+        if delay > 0:
+          time.sleep(delay)
+          now = time.time()
+
+      self.handlePackets(packets, now)
+      self.flushHosts(now)
+      num_packets += len(packets)
+
+    self.flushHosts(time.time(), force=True)
+    self.msg_queue.put(ReplayEnd(num_packets, time.time() - start))
+    pkt_reader.close_capture_dev(handle)
+
   def task(self, msg_queue, cp_eventsqueue, config_changeev, passive_mode):
     self.msg_queue = msg_queue
     self.cp_eventsqueue = cp_eventsqueue
     self.passive_mode = passive_mode
     self.config_changeev = config_changeev
-    self.macs_to_spoof = {}
-    self.ip_to_mac = {}
+
+    if self.options.get("replay_file"):
+      self.replay(self.options["replay_file"], self.options.get("replay_speed", "max"))
+      return
+
+    self.ip_to_mac = MetaDB(readonly=True).ipToMacMap(time.time() - IP_TO_MAC_WARMUP_SEC)
+    self.compilePolicies()
 
     # Acquire capabilities to capture packets
     acquire_capabilities()
 
     # TODO make interface configurable
-    handle = pkt_reader.open_capture_dev(self.options["interface"], 1000, "broadcast or arp", False)
+    # NOTE: immediate mode, so that the selectable fd is readable as soon as a packet arrives
+    handle = pkt_reader.open_capture_dev(self.options["interface"], 1000, "broadcast or arp", True,
+      self.options.get("capture_ring", False))
     self.gateway_mac = pkt_reader.get_gateway_mac(handle)
     self.iface_ip = pkt_reader.get_iface_ip(handle)
     self.iface_mac = pkt_reader.get_iface_mac(handle)
     self.lan_network = pkt_reader.get_lan_network(handle)
     self.handle = handle
+    self.macs_to_spoof = SpoofScheduler(lambda mac, ip: pkt_reader.make_arp_req_spoof(handle, mac, ip))
 
     if(not self.passive_mode):
       print("[NET:%s] [IP: %s] [MAC: %s] Gateway %s (%s)" % (self.lan_network, self.iface_ip, self.iface_mac, self.gateway_mac, pkt_reader.get_gateway_ip(handle)))
@@ -213,71 +543,58 @@ class PacketsReaderJob(Job):
       self.setupCaptiveNat()
       self.reloadExceptions()
 
+    pkt_reader.set_nonblock(handle, True)
     last_request_spoof = 0
 
-    while self.isRunning():
-      info = pkt_reader.read_packet_info(handle)
-      now = time.time()
-
-      # Check for captive portal events
-      while cp_eventsqueue[1].poll():
-        (msg_type, ip) = cp_eventsqueue[1].recv()
-
-        if(msg_type == "auth_ok"):
-          # A device was successfully authenticated
-          mac = self.ip_to_mac.get(ip)
-
-          if not mac:
-            print("Warning: unknown device with IP: " + ip)
-          else:
-            # Verify that the device has actually a captive_portal logic
-            policy = getDevicePolicy(mac)
-
-            if policy == "captive_portal":
-              print("Whitelisting device [MAC=%s][IP=%s]" % (mac, ip))
-              self.whitelisted_devices[mac] = True
-
-              # Spoof the device back to the original gateway
-              pkt_reader.arp_rearp(handle, mac, ip)
-              self.macs_to_spoof.pop(mac, None)
-
-      # Check for config change events
-      if self.config_changeev.is_set():
-        config.reload()
-        self.reloadExceptions()
-        self.config_changeev.clear()
+    # Wait for whichever comes first among the packets, the captive portal
+    # events, the config changes and the termination request. The spoofing
+    # and the hosts flush are scheduled as deadlines.
+    selector = selectors.DefaultSelector()
+    selector.register(pkt_reader.get_selectable_fd(handle), selectors.EVENT_READ, "packets")
+    selector.register(cp_eventsqueue[1], selectors.EVENT_READ, "captive_portal")
+    selector.register(config_changeev, selectors.EVENT_READ, "config")
+    selector.register(self.terminationFileno(), selectors.EVENT_READ, "terminate")
 
-      if info:
-        name = info.get("name")
-        mac = info["mac"]
-        ip = info["ip"]
-
-        self.handleHost(mac, ip, name, now)
-
-        #print(info)
+    while self.isRunning():
+      deadlines = []
+      spoof_deadline = self.macs_to_spoof.nextDeadline()
 
-        if self.shouldSpoof(mac, ip):
-          if(info.get("proto") == "ARP_REQ"):
-            # Immediately spoof the reply
-            pkt_reader.arp_rep_spoof(handle, mac, ip)
+      if spoof_deadline is not None:
+        # Keep the spoofing in bursts
+        deadlines.append(max(spoof_deadline, last_request_spoof + SPOOFING_TIMEOUT))
+      if self.pending_hosts:
+        deadlines.append(self.last_hosts_flush + HOSTS_FLUSH_INTERVAL)
 
-          self.macs_to_spoof[mac] = {"last_seen": now, "ip": ip}
+      timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+      events = selector.select(timeout)
+      now = time.time()
 
-        self.ip_to_mac[ip] = mac
+      for key, _ in events:
+        if key.data == "packets":
+          self.handlePackets(pkt_reader.read_packets(handle, READ_BATCH_SIZE, 0), now)
+        elif key.data == "captive_portal":
+          self.handleCaptivePortalEvents()
+        elif key.data == "config":
+          # Clear before reloading, so that a change made meanwhile is not lost
+          self.config_changeev.clear()
+          config.reload()
+          self.compilePolicies()
+          self.reloadExceptions()
+
+      self.flushHosts(now)
+      self.expireWhitelisted(now)
 
       if((now - last_request_spoof) >= SPOOFING_TIMEOUT):
-        idle_macs = []
+        # Send all the due frames in a single burst
+        frames = self.macs_to_spoof.dueFrames(now)
 
-        for mac, mac_info in self.macs_to_spoof.items():
-          if((now - mac_info["last_seen"]) < SPOOFED_MAC_IDLE_TIMEOUT):
-            pkt_reader.arp_req_spoof(handle, mac, mac_info["ip"])
-          else:
-            idle_macs.append(mac)
+        if frames:
+          pkt_reader.send_frames(handle, frames)
+          last_request_spoof = now
 
-        for mac in idle_macs:
-          self.macs_to_spoof.pop(mac, None)
+    selector.close()
 
-        last_request_spoof = now
+    self.flushHosts(time.time(), force=True)
 
     # Spoof the devices back to the original gateway
     for mac, mac_info in self.macs_to_spoof.items():
@@ -287,3 +604,239 @@ class PacketsReaderJob(Job):
       self.termCaptiveNat()
 
     pkt_reader.close_capture_dev(handle)
+
+def benchmarkPolicies(num_devices=64, num_packets=1000000):
+  import tempfile
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    config.CONFIG_FILE = os.path.join(tmpdir, "config.json")
+    macs = ["00:11:22:33:%02X:%02X" % (i // 256, i % 256) for i in range(1, num_devices + 1)]
+    policies = ["pass", "block", "capture", "default"]
+
+    for i, mac in enumerate(macs):
+      config.addDevice(mac, "device", False, None, False, policies[i % len(policies)])
+
+    job = PacketsReaderJob()
+    job.passive_mode = False
+    job.gateway_mac = "00:00:00:00:00:01"
+    job.iface_mac = "00:00:00:00:00:02"
+    job.compilePolicies()
+
+    # Half of the packets come from unconfigured devices
+    packets = [(macs[i % num_devices] if (i % 2) else "00:AA:BB:CC:DD:%02X" % (i % 256), "192.168.1.2") for i in range(num_packets)]
+
+    # The per packet config walk performed before the policies were compiled
+    def configDevicePolicy(mac):
+      mac_info = config.getDeviceInfo(mac)
+
+      if mac_info:
+        policy = mac_info.get("policy", "default")
+
+        if not policy:
+          policy = "default"
+
+        if policy != "default":
+          return(policy)
+
+      # Default policy
+      if config.getCaptivePortalEnabled():
+        return "captive_portal"
+
+      return "pass"
+
+    # The checks performed before the policies were compiled, without the log line
+    def configShouldSpoof(mac, ip):
+      if (not job.passive_mode) and (mac != job.gateway_mac) and \
+          (mac != job.iface_mac) and (mac != "00:00:00:00:00:00") and \
+          (ip != "0.0.0.0") and (not job.whitelisted_devices.get(mac)):
+        policy = configDevicePolicy(mac)
+        return (policy == "block") or (policy == "captive_portal") or (policy == "capture")
+
+      return False
+
+    start = time.time()
+    before = [configShouldSpoof(mac, ip) for mac, ip in packets]
+    print("config lookup: %.0f packets/s" % (num_packets / (time.time() - start)))
+
+    start = time.time()
+    after = [job.shouldSpoof(mac, ip) for mac, ip in packets]
+    print("compiled policies: %.0f packets/s" % (num_packets / (time.time() - start)))
+
+    assert(before == after)
+
+def testSpoofScheduler():
+  scheduler = SpoofScheduler(lambda mac, ip: (mac, ip))
+  now = 1000
+
+  scheduler.spoof("AA:AA:AA:AA:AA:AA", "192.168.1.2", now)
+  scheduler.spoof("BB:BB:BB:BB:BB:BB", "192.168.1.3", now)
+  assert(sorted(scheduler.dueFrames(now)) == [("AA:AA:AA:AA:AA:AA", "192.168.1.2"), ("BB:BB:BB:BB:BB:BB", "192.168.1.3")])
+  assert(scheduler.dueFrames(now + SPOOFING_TIMEOUT / 2) == [])
+
+  # Replaced and removed targets
+  scheduler.spoof("AA:AA:AA:AA:AA:AA", "192.168.1.4", now + SPOOFING_TIMEOUT / 2)
+  scheduler.pop("BB:BB:BB:BB:BB:BB")
+  assert(scheduler.dueFrames(now + SPOOFING_TIMEOUT) == [("AA:AA:AA:AA:AA:AA", "192.168.1.4")])
+
+  # Idle targets expire
+  now += SPOOFED_MAC_IDLE_TIMEOUT + SPOOFING_TIMEOUT
+  assert(scheduler.dueFrames(now) == [])
+  assert((scheduler.get("AA:AA:AA:AA:AA:AA") == None) and (len(scheduler.heap) == 0))
+
+def testHostsCoalescing():
+  class QueueMock(list):
+    put = list.append
+
+  job = PacketsReaderJob()
+  job.msg_queue = QueueMock()
+  now = 1000
+
+  # 100 packets in a second from the same host, flushed as in the task loop
+  for i in range(100):
+    job.handleHost("AA:AA:AA:AA:AA:AA", "192.168.1.2", None, now)
+    job.flushHosts(now)
+    now += 0.01
+
+  # The new host, then once per interval
+  assert(len(job.msg_queue) <= 2)
+  assert(sum([msg.count for messages in job.msg_queue for msg in messages]) + \
+    sum([msg.count for msg in job.pending_hosts.values()]) == 100)
+
+  # IP and name changes are sent immediately
+  num_puts = len(job.msg_queue)
+  job.handleHost("AA:AA:AA:AA:AA:AA", "192.168.1.3", None, now)
+  job.flushHosts(now)
+  job.handleHost("AA:AA:AA:AA:AA:AA", "192.168.1.3", "phone", now)
+  job.flushHosts(now)
+  job.handleHost("AA:AA:AA:AA:AA:AA", "192.168.1.3", None, now)
+  job.flushHosts(now)
+  assert(len(job.msg_queue) == num_puts + 2)
+
+def testWhitelistedDevices():
+  job = PacketsReaderJob()
+  job.cp_session_time = 100
+
+  assert(not job.refreshWhitelisted("AA:AA:AA:AA:AA:AA", 0))
+  assert(job.refreshWhitelisted("AA:AA:AA:AA:AA:AA", 0, add=True))
+  assert(job.refreshWhitelisted("BB:BB:BB:BB:BB:BB", 10, add=True))
+
+  # Activity refreshes the session
+  assert(job.refreshWhitelisted("AA:AA:AA:AA:AA:AA", 90))
+  job.expireWhitelisted(115)
+  assert(list(job.whitelisted_devices.keys()) == ["AA:AA:AA:AA:AA:AA"])
+
+  # Expired sessions are not refreshed
+  assert(not job.refreshWhitelisted("AA:AA:AA:AA:AA:AA", 190))
+  assert(not job.whitelisted_devices)
+
+def testNftPolicyDelta():
+  assert(nftPolicyDelta({"a": "whitelisted"}, {"a": "whitelisted"}) == [])
+  assert(nftPolicyDelta({"a": "whitelisted", "b": "whitelisted"}, {"b": "blacklisted", "c": "whitelisted"}) == [
+    "delete element ip nat cp_policy { a, b }", "add element ip nat cp_policy { b : accept, c : accept }",
+    "delete element ip filter cp_policy { a, b }", "add element ip filter cp_policy { b : drop, c : accept }"])
+
+# Compare the captive portal ruleset with the one based on the separate
+# cp_whitelisted/cp_blacklisted sets in both tables, which it replaced. The
+# rulesets are validated with "nft --check" when nft is available.
+def benchmarkNftRulesets():
+  import re
+  import subprocess
+  import tempfile
+
+  job = PacketsReaderJob()
+  job.options = {"interface": "eth0"}
+  job.lan_network = "192.168.1.0/24"
+  job.iface_ip = "192.168.1.1"
+
+  sets_layout = [
+    "add table ip nat",
+    "add table ip filter",
+    "add chain ip nat nw_prerouting { type nat hook prerouting priority -100; }",
+    "add chain ip nat nw_postrouting { type nat hook postrouting priority -100; }",
+    "add chain ip filter nw_forward { type filter hook forward priority 0; }",
+  ] + ["add set ip %s %s { type %s;}" % (table, name, set_type) for table in ("nat", "filter")
+    for name, set_type in (("cp_auth_ok", "ipv4_addr"), ("cp_whitelisted", "ether_addr"), ("cp_blacklisted", "ether_addr"))] + [
+    "add rule nat nw_prerouting iif eth0 tcp dport { 80 } ip saddr 192.168.1.0/24 ip saddr != @cp_auth_ok ether saddr != @cp_whitelisted ether saddr != @cp_blacklisted counter dnat 192.168.1.1:9000",
+    "add rule nat nw_postrouting oif eth0 ip saddr 192.168.1.0/24 counter masquerade",
+    "add rule filter nw_forward ether saddr @cp_blacklisted counter drop",
+    "add rule filter nw_forward iif eth0 ip saddr 192.168.1.0/24 udp dport { 53 } counter accept",
+    "add rule filter nw_forward iif eth0 ct state new ip saddr 192.168.1.0/24 ip saddr != @cp_auth_ok ether saddr != @cp_whitelisted counter drop",
+  ]
+  map_layout = job.initNftablesCommands() + job.captiveRulesCommands(9000)
+
+  # The sets and maps containing each device
+  devices = (
+    ("configured device", frozenset(["cp_whitelisted", "cp_policy"])),
+    ("unconfigured device", frozenset()),
+  )
+
+  # The expressions not matching a LAN packet to tcp port 443, by packet kind
+  mismatches = {
+    "new": ("udp dport", "tcp dport { 80 }"),
+    "established": ("udp dport", "tcp dport { 80 }", "ct state new"),
+  }
+
+  # Returns the set and map lookups performed by the chain on the packet.
+  # Expressions are evaluated in order, until the first mismatch or verdict.
+  def chainLookups(rules, mismatches, members):
+    lookups = 0
+
+    for rule in rules:
+      exprs = [(rule.find(m), None, None) for m in mismatches if m in rule]
+      exprs += [(m.start(), m.group(1), m.group(2)) for m in re.finditer(r"(vmap |!= |update )?@(\w+)", rule)]
+      matched = True
+
+      for _, kind, name in sorted(exprs):
+        if kind == "update ":
+          # A statement, not a match
+          continue
+        elif name is None:
+          matched = False
+          break
+
+        lookups += 1
+
+        if kind == "vmap ":
+          if name in members:
+            return lookups
+        elif (name in members) == (kind == "!= "):
+          matched = False
+          break
+
+      if matched and re.search(r" (accept|drop|dnat .*)$", rule):
+        break
+
+    return lookups
+
+  for name, cmds in (("sets", sets_layout), ("verdict map", map_layout)):
+    rules = [cmd for cmd in cmds if cmd.startswith("add rule")]
+    prerouting_rules = [cmd for cmd in rules if " nw_prerouting " in cmd]
+    forward_rules = [cmd for cmd in rules if " nw_forward " in cmd]
+    sets = [cmd for cmd in cmds if cmd.startswith("add set") or cmd.startswith("add map")]
+
+    print("%s: %d rules, %d sets/maps" % (name, len(rules), len(sets)))
+
+    # The nat chains only see the first packet of a connection
+    for device, members in devices:
+      print("  %s: %d + %d lookups on a new connection (prerouting + forward), %d per established packet" % (device,
+        chainLookups(prerouting_rules, mismatches["new"], members),
+        chainLookups(forward_rules, mismatches["new"], members),
+        chainLookups(forward_rules, mismatches["established"], members)))
+
+    with tempfile.NamedTemporaryFile("w", suffix=".nft") as f:
+      f.write("\n".join(cmds) + "\n")
+      f.flush()
+
+      try:
+        rv = subprocess.run(["nft", "--check", "-f", f.name], capture_output=True)
+        print("  nft --check: %s" % ("ok" if (rv.returncode == 0) else rv.stderr.decode().strip()))
+      except OSError:
+        print("  nft --check: nft not available")
+
+if __name__ == "__main__":
+  testSpoofScheduler()
+  testHostsCoalescing()
+  testWhitelistedDevices()
+  testNftPolicyDelta()
+  benchmarkNftRulesets()
+  benchmarkPolicies()
@@ -18,23 +18,219 @@
 #
 
 import sqlite3
-from utils.db import deviceToKey, keyToDevice
+import itertools
+import functools
+import operator
+from utils.db import deviceToId, idToDevice, migrateTables, initConnection, connectReadOnly
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 PRESENCE_DB = "data/presence.db"
 RESOLUTION = 60
+SCHEMA_VERSION = 6
 
-class PresenceDB():
+# How minute datapoints are stored:
+#  - points: one (timestamp, mac) row per active device per minute
+#  - intervals: one (mac, start, end) row per presence interval, extended in
+#    place by insert() while the device stays active
+# Existing data is migrated when the mode is changed.
+STORAGE_MODE = "points"
+
+# Rebuild the intervals with NumPy, when available
+USE_NUMPY = (numpy is not None)
+
+# Rollup tables, incrementally updated by insert(). Each row represents the
+# presence of a device in a time bucket, along with the first and last
+# datapoint seen within the bucket.
+# resolution -> (table, bucket expression, column to report, interval edge)
+ROLLUPS = {
+  "1h": ("presence_hourly", "(CAST({ts} AS INTEGER) / 3600) * 3600", "last", 3600),
+  "24h": ("presence_daily", "CAST(strftime('%s', strftime('%Y-%m-%d', {ts}, 'unixepoch'), 'utc') AS INTEGER)", "bucket", 86400),
+  "1M": ("presence_monthly", "CAST(strftime('%s', strftime('%Y-%m-01 00:00:00', {ts}, 'unixepoch'), 'utc') AS INTEGER)", "bucket", 2678400),
+}
+
+# Retention levels: the data of a resolution ("1m" for the minute datapoints)
+# can be compacted into the next coarser one
+COMPACTION = {
+  "1m": "1h",
+  "1h": "24h",
+  "24h": "1M",
+}
+
+# Per-day presence bitmaps, updated by insert() along with the datapoints: bit
+# N of a device bitmap is set when the device was seen at the N-th minute of
+# the UTC day. Bitmaps have a fixed size and are kept with the hourly data.
+BITMAP_SLOTS = 86400 // RESOLUTION
+BITMAP_BYTES = BITMAP_SLOTS // 8
+
+def _bitmapDay(tstamp):
+  tstamp = int(tstamp)
+  return tstamp - tstamp % 86400
+
+def _bitmapSlot(day, tstamp):
+  return int(tstamp - day) // RESOLUTION
+
+def _bitmapSet(bits, slot):
+  bits = bytearray(bits or BITMAP_BYTES)
+  bits[slot >> 3] |= 1 << (slot & 7)
+  return bytes(bits)
+
+# Aggregate building the bitmap of the datapoints of a day
+class _BitmapAggregate():
   def __init__(self):
-    self.conn = sqlite3.connect(PRESENCE_DB)
+    self.bits = bytearray(BITMAP_BYTES)
+
+  def step(self, tstamp):
+    slot = _bitmapSlot(_bitmapDay(tstamp), tstamp)
+    self.bits[slot >> 3] |= 1 << (slot & 7)
+
+  def finalize(self):
+    return bytes(self.bits)
+
+# Generator of the (start, end) intervals of the set bits of a day bitmap
+def _bitmapIntervals(day, bits):
+  while bits:
+    first = (bits & -bits).bit_length() - 1
+    length = ((bits >> first) ^ ((bits >> first) + 1)).bit_length() - 1
+    bits &= ~(((1 << length) - 1) << first)
+    yield (day + first * RESOLUTION, day + (first + length - 1) * RESOLUTION)
+
+class PresenceDB():
+  # A readonly instance can only be used for queries
+  def __init__(self, db_path=PRESENCE_DB, storage_mode=STORAGE_MODE, use_numpy=USE_NUMPY, readonly=False):
+    self.conn = connectReadOnly(db_path) if readonly else sqlite3.connect(db_path)
     self.cursor = self.conn.cursor()
-    self._initTable()
+    self.storage_mode = storage_mode
+    self.use_numpy = use_numpy
+    self.open_intervals = {}
+    self.conn.create_function("bitmap_set", 2, _bitmapSet, deterministic=True)
+    self.conn.create_aggregate("bitmap_agg", 1, _BitmapAggregate)
+
+    if not readonly:
+      initConnection(self.conn)
+      self._initTable()
+
+  # NOTE: tables are WITHOUT ROWID, so the primary key and the indexes
+  # (which include the primary key columns) cover all the queries:
+  #  - presence: (timestamp, mac) for time ranges, (mac, timestamp) for a device
+  #  - rollups: (bucket, mac) for time ranges
+  #  - presence_intervals: (mac, start) for a device, (end, mac, start) for time ranges
+  # See checkQueryPlans().
+  def _createTables(self):
+    self.cursor.execute("""CREATE TABLE IF NOT EXISTS presence (timestamp INTEGER NOT NULL, mac INTEGER NOT NULL, PRIMARY KEY (timestamp, mac)) WITHOUT ROWID""")
+    self.cursor.execute("""CREATE INDEX IF NOT EXISTS idx_presence_mac_timestamp ON presence (mac, timestamp)""")
+
+    for table, _, _, _ in ROLLUPS.values():
+      self.cursor.execute("""CREATE TABLE IF NOT EXISTS %s (bucket INTEGER NOT NULL, mac INTEGER NOT NULL, first INTEGER NOT NULL, last INTEGER NOT NULL, PRIMARY KEY (bucket, mac)) WITHOUT ROWID""" % table)
+
+    self.cursor.execute("""CREATE TABLE IF NOT EXISTS presence_intervals (mac INTEGER NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL, PRIMARY KEY (mac, start)) WITHOUT ROWID""")
+    self.cursor.execute("""CREATE INDEX IF NOT EXISTS idx_presence_intervals_end ON presence_intervals (end)""")
+
+    self.cursor.execute("""CREATE TABLE IF NOT EXISTS presence_bitmaps (day INTEGER NOT NULL, mac INTEGER NOT NULL, bits BLOB NOT NULL, PRIMARY KEY (day, mac)) WITHOUT ROWID""")
+
+    # For each resolution, the time before which its data was compacted
+    self.cursor.execute("""CREATE TABLE IF NOT EXISTS presence_compaction (resolution TEXT NOT NULL, before INTEGER NOT NULL, PRIMARY KEY (resolution)) WITHOUT ROWID""")
 
   def _initTable(self):
-    self.cursor.execute("""CREATE TABLE IF NOT EXISTS presence (timestamp INTEGER NOT NULL, mac CHARACTER(12) NOT NULL, PRIMARY KEY (timestamp, mac))""")
-    self.cursor.execute("""CREATE INDEX IF NOT EXISTS idx_presence_mac ON presence (mac)""")
-    self.cursor.execute("""CREATE INDEX IF NOT EXISTS idx_presence_timestamp ON presence (timestamp)""")
+    version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+
+    if version < 5:
+      # Let compact() release the free pages with incremental_vacuum
+      self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+      self.cursor.execute("VACUUM")
+
+    if version < 4:
+      # Tables are rebuilt as WITHOUT ROWID
+      column_exprs = {}
+
+      if version < 2:
+        # MAC addresses were stored as 12 characters strings
+        self.conn.create_function("key_to_id", 1, lambda key: int(key, 16))
+        column_exprs["mac"] = "key_to_id(mac)"
+
+      migrateTables(self.cursor, self._createTables, column_exprs)
+    else:
+      self._createTables()
+
+    if version < 1:
+      # Databases created before the rollup tables were introduced
+      self.rebuildRollups(commit=False)
+    elif version < 6:
+      self._rebuildBitmaps()
+
+    if version != SCHEMA_VERSION:
+      self.cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    self._migrateStorage()
     self.conn.commit()
 
+  # Move the data stored with the other storage mode, if any
+  def _migrateStorage(self):
+    if self.storage_mode == "intervals":
+      if not self.cursor.execute("SELECT 1 FROM presence LIMIT 1").fetchone():
+        return
+
+      res = self.conn.execute("SELECT mac, timestamp FROM presence ORDER BY mac, timestamp")
+      self.cursor.executemany("INSERT INTO presence_intervals (mac, start, end) VALUES (?,?,?)", self._mergePoints(res))
+      self.cursor.execute("DELETE FROM presence")
+    elif self.storage_mode == "points":
+      if not self.cursor.execute("SELECT 1 FROM presence_intervals LIMIT 1").fetchone():
+        return
+
+      self.cursor.execute("INSERT OR IGNORE INTO presence (timestamp, mac) " + self._expandedIntervals())
+      self.cursor.execute("DELETE FROM presence_intervals")
+    else:
+      raise ValueError("Unknown storage mode: " + str(self.storage_mode))
+
+  # Merge (mac, timestamp) rows, sorted by mac and timestamp, into (mac, start, end) intervals
+  def _mergePoints(self, res, interval_edge=RESOLUTION):
+    cur_id = None
+    start = end = None
+
+    for device_id, tstamp in res:
+      if (device_id != cur_id) or ((tstamp - end) > interval_edge):
+        if cur_id is not None:
+          yield (cur_id, start, end)
+
+        cur_id = device_id
+        start = tstamp
+
+      end = tstamp
+
+    if cur_id is not None:
+      yield (cur_id, start, end)
+
+  # A SELECT returning a (timestamp, mac) row for each datapoint covered by
+  # the stored intervals matching the where clause
+  def _expandedIntervals(self, where=""):
+    return "WITH RECURSIVE points (timestamp, mac, end) AS (SELECT start, mac, end FROM presence_intervals " + where + \
+      " UNION ALL SELECT timestamp + %d, mac, end FROM points WHERE timestamp + %d <= end) SELECT timestamp, mac FROM points" % (RESOLUTION, RESOLUTION)
+
+  def _allDatapoints(self):
+    return "SELECT timestamp, mac FROM presence UNION ALL SELECT * FROM (" + self._expandedIntervals() + ")"
+
+  def _rebuildBitmaps(self):
+    self.cursor.execute("DELETE FROM presence_bitmaps")
+    self.cursor.execute("INSERT INTO presence_bitmaps (day, mac, bits) SELECT (CAST(timestamp AS INTEGER) / 86400) * 86400, mac, bitmap_agg(timestamp) FROM (%s) GROUP BY 1, 2" % (
+      self._allDatapoints()))
+
+  # Recompute the rollup tables and the bitmaps from the raw presence data
+  def rebuildRollups(self, commit=True):
+    datapoints = self._allDatapoints()
+
+    for table, bucket, _, _ in ROLLUPS.values():
+      self.cursor.execute("DELETE FROM %s" % table)
+      self.cursor.execute("INSERT INTO %s (bucket, mac, first, last) SELECT %s, mac, min(timestamp), max(timestamp) FROM (%s) GROUP BY 1, 2" % (
+        table, bucket.format(ts="timestamp"), datapoints))
+
+    self._rebuildBitmaps()
+
+    if commit:
+      self.conn.commit()
+
   def _getIntervals(self, devices_to_tstamp, interval_edge):
     hosts_intervals = {}
 
@@ -65,8 +261,8 @@ class PresenceDB():
     devices_to_tstamp = {}
 
     for row in res:
-      tstamp, device_key = row
-      device = keyToDevice(device_key)
+      tstamp, device_id = row
+      device = idToDevice(device_id)
 
       if not device in devices_to_tstamp:
         devices_to_tstamp[device] = []
@@ -74,53 +270,546 @@ class PresenceDB():
       devices_to_tstamp[device].append(int(tstamp))
     return devices_to_tstamp
 
+  # Vectorized equivalent of _getIntervals(_groupByDevice(res))
+  def _getIntervalsNumpy(self, res, interval_edge):
+    rows = res.fetchall() if hasattr(res, "fetchall") else res
+    hosts_intervals = {}
+
+    if not len(rows):
+      return hosts_intervals
+
+    rows = numpy.fromiter(itertools.chain.from_iterable(rows), dtype=numpy.int64, count=2 * len(rows)).reshape(-1, 2)
+
+    # Sort by device, then by timestamp
+    order = numpy.lexsort((rows[:, 0], rows[:, 1]))
+    tstamps = rows[order, 0]
+    device_ids = rows[order, 1]
+
+    # A new interval starts on a device change or on a gap bigger than interval_edge
+    breaks = numpy.empty(len(tstamps), dtype=bool)
+    breaks[0] = True
+    breaks[1:] = (device_ids[1:] != device_ids[:-1]) | ((tstamps[1:] - tstamps[:-1]) > interval_edge)
+
+    first_idx = numpy.flatnonzero(breaks)
+    last_idx = numpy.append(first_idx[1:] - 1, len(tstamps) - 1)
+    starts = tstamps[first_idx].tolist()
+    ends = tstamps[last_idx].tolist()
+    interval_devices = device_ids[first_idx]
+
+    # Split the intervals per device
+    device_idx = numpy.flatnonzero(numpy.append(True, interval_devices[1:] != interval_devices[:-1])).tolist()
+    device_idx.append(len(starts))
+
+    for i in range(len(device_idx) - 1):
+      lo, hi = device_idx[i], device_idx[i + 1]
+      hosts_intervals[idToDevice(int(interval_devices[lo]))] = list(zip(starts[lo:hi], ends[lo:hi]))
+
+    return hosts_intervals
+
+  # Build the devices intervals from the (timestamp, mac) rows of res
+  def _rowsToIntervals(self, res, interval_edge):
+    if self.use_numpy and numpy:
+      return self._getIntervalsNumpy(res, interval_edge)
+
+    devices_to_tstamp = self._groupByDevice(res)
+    return self._getIntervals(devices_to_tstamp, interval_edge)
+
+  def _updateRollups(self, tstamp, device_ids):
+    params = [{"ts": tstamp, "mac": device_id} for device_id in device_ids]
+
+    for table, bucket, _, _ in ROLLUPS.values():
+      self.cursor.executemany("INSERT INTO " + table + " (bucket, mac, first, last) VALUES (" + bucket.format(ts=":ts") + ", :mac, :ts, :ts)"
+        " ON CONFLICT (bucket, mac) DO UPDATE SET first = min(first, excluded.first), last = max(last, excluded.last)", params)
+
+  def _updateBitmaps(self, tstamp, device_ids):
+    day = _bitmapDay(tstamp)
+    slot = _bitmapSlot(day, tstamp)
+
+    self.cursor.executemany("INSERT INTO presence_bitmaps (day, mac, bits) VALUES (:day, :mac, bitmap_set(NULL, :slot))"
+      " ON CONFLICT (day, mac) DO UPDATE SET bits = bitmap_set(bits, :slot)",
+      [{"day": day, "mac": device_id, "slot": slot} for device_id in device_ids])
+
+  def _extendIntervals(self, tstamp, device_ids):
+    extended = []
+    opened = []
+
+    for device_id in device_ids:
+      interval = self.open_intervals.get(device_id)
+
+      if not interval:
+        interval = self.cursor.execute("SELECT start, end FROM presence_intervals WHERE mac = ? ORDER BY start DESC LIMIT 1", (device_id,)).fetchone()
+
+      if interval and (interval[1] < tstamp) and ((tstamp - interval[1]) <= RESOLUTION):
+        # The device is still present, extend its last interval
+        extended.append((tstamp, device_id, interval[0]))
+        self.open_intervals[device_id] = (interval[0], tstamp)
+      elif (not interval) or (interval[1] < tstamp):
+        opened.append((device_id, tstamp, tstamp))
+        self.open_intervals[device_id] = (tstamp, tstamp)
+
+    self.cursor.executemany("UPDATE presence_intervals SET end = ? WHERE mac = ? AND start = ?", extended)
+    self.cursor.executemany("INSERT INTO presence_intervals (mac, start, end) VALUES (?,?,?)", opened)
+
+  # Insert the datapoints of the devices active at tstamp, in a single transaction
   def insert(self, tstamp, devices):
-    for device in devices:
-      device_key = deviceToKey(device)
-      self.cursor.execute("INSERT INTO presence VALUES (?,?)", (tstamp, device_key))
+    device_ids = [deviceToId(device) for device in devices]
 
+    if self.storage_mode == "intervals":
+      self._extendIntervals(tstamp, device_ids)
+    else:
+      self.cursor.executemany("INSERT INTO presence VALUES (?,?)", [(tstamp, device_id) for device_id in device_ids])
+
+    self._updateRollups(tstamp, device_ids)
+    self._updateBitmaps(tstamp, device_ids)
     self.conn.commit()
 
-  def query(self, tstamp_start, tstamp_end, device_filter=None, resolution=None):
-    q = " FROM presence WHERE timestamp >= ? AND timestamp <= ?"
-    time_what = "timestamp"
+  # Returns the (time, from_where, params, interval_edge) to select the
+  # datapoints of the given time range
+  def _datapointsQuery(self, tstamp_start, tstamp_end, device_id, resolution):
+    params = {"start": tstamp_start, "end": tstamp_end}
+
+    if resolution in ROLLUPS:
+      table, bucket, time_what, interval_edge = ROLLUPS[resolution]
+
+      # The bucket range is used to perform an index lookup, first/last restrict
+      # the result to the buckets with some datapoints into the time range
+      q = " FROM " + table + " WHERE bucket >= " + bucket.format(ts=":start") + " AND bucket <= " + bucket.format(ts=":end") + \
+        " AND last >= :start AND first <= :end"
+    else:
+      time_what = "timestamp"
+      interval_edge = RESOLUTION
+      q = " FROM presence WHERE timestamp >= :start AND timestamp <= :end"
+
+    if device_id is not None:
+      q = q + " AND mac = :mac"
+      params["mac"] = device_id
+
+    return time_what, q, params, interval_edge
+
+  # Generator of the (mac, start, end) stored intervals, clipped to the time range.
+  # Intervals are sorted by start only when device_id is specified.
+  def _iterStoredIntervals(self, cursor, tstamp_start, tstamp_end, device_id):
+    q = "SELECT mac, start, end FROM presence_intervals WHERE end >= ? AND start <= ?"
     params = [tstamp_start, tstamp_end]
-    interval_edge = RESOLUTION
-
-    if device_filter:
-      q = q + " AND mac = ?"
-      params.append(deviceToKey(device_filter))
-
-    if resolution == "1h":
-      q = q + " GROUP BY strftime('%H', datetime(timestamp, 'unixepoch')), mac"
-      interval_edge = 3600
-    elif resolution == "24h":
-      time_what = "strftime('%s', strftime('%Y-%m-%d', timestamp, 'unixepoch'), 'utc')"
-      q = q + " GROUP BY strftime('%m-%d', datetime(timestamp, 'unixepoch')), mac"
-      interval_edge = 86400
-    elif resolution == "1M":
-      time_what = "strftime('%s', strftime('%Y-%m-01 00:00:00', timestamp, 'unixepoch'), 'utc')"
-      q = q + " GROUP BY strftime('%Y-%m', datetime(timestamp, 'unixepoch')), mac"
-      interval_edge = 2678400
+
+    if device_id is not None:
+      q = q + " AND mac = ? ORDER BY start"
+      params.append(device_id)
+
+    for device_id, start, end in cursor.execute(q, params):
+      # Clip the interval to the datapoints within the time range
+      if start < tstamp_start:
+        start += -((start - tstamp_start) // RESOLUTION) * RESOLUTION
+      if end > tstamp_end:
+        end -= -((tstamp_end - end) // RESOLUTION) * RESOLUTION
+
+      if start <= end:
+        yield (device_id, int(start), int(end))
+
+  # Generator of the (mac, start, end) intervals of a device, or of all the
+  # devices when device_id is None
+  def _iterDeviceIntervals(self, cursor, tstamp_start, tstamp_end, device_id, resolution):
+    if (resolution not in ROLLUPS) and (device_id is None):
+      # Walk the devices one at a time, so that each query is an index range
+      # scan already sorted by timestamp. The devices are taken from the hourly rollup.
+      _, q, params, _ = self._datapointsQuery(tstamp_start, tstamp_end, None, "1h")
+      device_ids = [row[0] for row in cursor.execute("SELECT DISTINCT mac" + q + " ORDER BY mac", params).fetchall()]
+
+      for device_id in device_ids:
+        for interval in self._iterDeviceIntervals(cursor, tstamp_start, tstamp_end, device_id, resolution):
+          yield interval
+    elif (resolution not in ROLLUPS) and (self.storage_mode == "intervals"):
+      for interval in self._iterStoredIntervals(cursor, tstamp_start, tstamp_end, device_id):
+        yield interval
+    else:
+      time_what, q, params, interval_edge = self._datapointsQuery(tstamp_start, tstamp_end, device_id, resolution)
+      res = cursor.execute("SELECT mac, " + time_what + q + " ORDER BY mac, " + time_what, params)
+
+      for interval in self._mergePoints(res, interval_edge):
+        yield interval
+
+  # Merge the selected (timestamp, mac) datapoints into the given rollups
+  def _mergeIntoRollups(self, datapoints, resolutions, params):
+    for resolution in resolutions:
+      table, bucket, _, _ = ROLLUPS[resolution]
+
+      self.cursor.execute("INSERT INTO %s (bucket, mac, first, last) SELECT %s, mac, min(timestamp), max(timestamp) FROM (%s) WHERE true GROUP BY 1, 2"
+        " ON CONFLICT (bucket, mac) DO UPDATE SET first = min(first, excluded.first), last = max(last, excluded.last)" % (
+        table, bucket.format(ts="timestamp"), datapoints), params)
+
+  # Compact the data of the given resolution ("1m" for the minute datapoints)
+  # older than the before timestamp: the data is merged into the coarser
+  # rollups, then deleted. Works in windows of batch_seconds, each one in its
+  # own transaction; this is a generator which yields the number of rows
+  # deleted after each window is committed.
+  def compact(self, resolution, before, batch_seconds):
+    coarser = []
+    level = resolution
+
+    while level in COMPACTION:
+      level = COMPACTION[level]
+      coarser.append(level)
+
+    if resolution in ROLLUPS:
+      table, time_what = ROLLUPS[resolution][0], "bucket"
+      datapoints = "SELECT first AS timestamp, mac FROM " + table + " WHERE bucket >= :lo AND bucket < :hi AND last < :before" + \
+        " UNION ALL SELECT last, mac FROM " + table + " WHERE bucket >= :lo AND bucket < :hi AND last < :before"
+      delete = "DELETE FROM " + table + " WHERE bucket >= :lo AND bucket < :hi AND last < :before"
+    elif self.storage_mode == "intervals":
+      table, time_what = "presence_intervals", "end"
+      datapoints = self._expandedIntervals("WHERE end >= :lo AND end < :hi AND end < :before")
+      delete = "DELETE FROM presence_intervals WHERE end >= :lo AND end < :hi AND end < :before"
     else:
-      q = q + " GROUP BY timestamp, mac"
+      table, time_what = "presence", "timestamp"
+      datapoints = "SELECT timestamp, mac FROM presence WHERE timestamp >= :lo AND timestamp < :hi AND timestamp < :before"
+      delete = "DELETE FROM presence WHERE timestamp >= :lo AND timestamp < :hi AND timestamp < :before"
+
+    next_lo = "SELECT min(%s) FROM %s WHERE %s >= ?" % (time_what, table, time_what)
+    lo = self.cursor.execute(next_lo, (0,)).fetchone()[0]
+
+    while (lo is not None) and (lo < before):
+      hi = min(lo + batch_seconds, before)
+      params = {"lo": lo, "hi": hi, "before": before}
+
+      self._mergeIntoRollups(datapoints, coarser, params)
+      deleted = self.cursor.execute(delete, params).rowcount
+
+      if resolution == "1h":
+        # Drop the bitmaps of the days entirely compacted
+        self.cursor.execute("DELETE FROM presence_bitmaps WHERE day <= :hi - 86400", params)
+
+      self.cursor.execute("INSERT INTO presence_compaction (resolution, before) VALUES (?,?)"
+        " ON CONFLICT (resolution) DO UPDATE SET before = max(before, excluded.before)", (resolution, hi))
+      self.conn.commit()
+
+      yield deleted
+      lo = self.cursor.execute(next_lo, (hi,)).fetchone()[0]
+
+  # Release up to the given number of free pages to the filesystem
+  def vacuum(self, pages):
+    self.cursor.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+
+  # Data older than the compaction time of a resolution is only available
+  # with the coarser ones. Returns the resolution to use for the query.
+  def availableResolution(self, tstamp_start, resolution):
+    level = resolution if resolution in ROLLUPS else "1m"
+
+    while level in COMPACTION:
+      row = self.cursor.execute("SELECT before FROM presence_compaction WHERE resolution = ?", (level,)).fetchone()
+
+      if (not row) or (tstamp_start >= row[0]):
+        break
+
+      level = COMPACTION[level]
+
+    return level if level in ROLLUPS else resolution
+
+  # Generator of (device, start, end) tuples, sorted by device and start.
+  # Unlike query(), rows are consumed from the cursor as the intervals are
+  # yielded, so only the current interval is kept in memory.
+  def iterIntervals(self, tstamp_start, tstamp_end, device_filter=None, resolution=None):
+    device_id = deviceToId(device_filter) if device_filter else None
+    resolution = self.availableResolution(tstamp_start, resolution)
+
+    for device_id, start, end in self._iterDeviceIntervals(self.conn.cursor(), tstamp_start, tstamp_end, device_id, resolution):
+      yield (idToDevice(device_id), start, end)
+
+  def query(self, tstamp_start, tstamp_end, device_filter=None, resolution=None):
+    device_id = deviceToId(device_filter) if device_filter else None
+    resolution = self.availableResolution(tstamp_start, resolution)
+
+    if (resolution not in ROLLUPS) and (self.storage_mode == "intervals"):
+      hosts_intervals = {}
 
-    what = time_what + ", mac"
-    q = "SELECT " + what + q
+      for device_id, start, end in self._iterStoredIntervals(self.cursor, tstamp_start, tstamp_end, device_id):
+        hosts_intervals.setdefault(idToDevice(device_id), []).append((start, end))
+
+      for intervals in hosts_intervals.values():
+        intervals.sort()
+
+      return hosts_intervals
+
+    time_what, q, params, interval_edge = self._datapointsQuery(tstamp_start, tstamp_end, device_id, resolution)
     # print(q, params)
 
-    res = self.cursor.execute(q, params)
-    devices_to_tstamp = self._groupByDevice(res)
-    # print(devices_to_tstamp)
-    return self._getIntervals(devices_to_tstamp, interval_edge)
+    res = self.cursor.execute("SELECT " + time_what + ", mac" + q, params)
+    return self._rowsToIntervals(res, interval_edge)
+
+  # Generator of the (day, mac, bits) bitmaps, as integers masked to the time range
+  def _iterBitmaps(self, tstamp_start, tstamp_end, device_ids=None):
+    q = "SELECT day, mac, bits FROM presence_bitmaps WHERE day >= ? AND day <= ?"
+    params = [_bitmapDay(tstamp_start), tstamp_end]
+
+    if device_ids is not None:
+      q = q + " AND mac IN (" + ",".join(["?"] * len(device_ids)) + ")"
+      params.extend(device_ids)
+
+    for day, device_id, bits in self.conn.execute(q, params):
+      first = max(0, -int((day - tstamp_start) // RESOLUTION))
+      last = min(BITMAP_SLOTS - 1, int(tstamp_end - day) // RESOLUTION)
+
+      if first <= last:
+        yield (day, device_id, int.from_bytes(bits, "little") & (((1 << (last - first + 1)) - 1) << first))
+
+  # Returns the devices seen at the minute of tstamp
+  def presentAt(self, tstamp):
+    day = _bitmapDay(tstamp)
+    slot = _bitmapSlot(day, tstamp)
+    res = self.cursor.execute("SELECT mac, bits FROM presence_bitmaps WHERE day = ?", (day,))
+
+    return sorted([idToDevice(device_id) for device_id, bits in res if bits[slot >> 3] & (1 << (slot & 7))])
+
+  # Returns the (start, end) intervals in which all the devices were present
+  def presentTogether(self, tstamp_start, tstamp_end, devices):
+    device_ids = set([deviceToId(device) for device in devices])
+    days = {}
+    intervals = []
+
+    for day, _, bits in self._iterBitmaps(tstamp_start, tstamp_end, list(device_ids)):
+      days.setdefault(day, []).append(bits)
+
+    for day in sorted(days.keys()):
+      if len(days[day]) != len(device_ids):
+        continue
+
+      for start, end in _bitmapIntervals(day, functools.reduce(operator.and_, days[day])):
+        if intervals and (intervals[-1][1] + RESOLUTION == start):
+          # Continues across midnight
+          intervals[-1] = (intervals[-1][0], end)
+        else:
+          intervals.append((start, end))
+
+    return intervals
+
+  # Returns the number of minutes each device was present
+  def presenceMinutes(self, tstamp_start, tstamp_end, device_filter=None):
+    device_ids = [deviceToId(device_filter)] if device_filter else None
+    counts = {}
+
+    for _, device_id, bits in self._iterBitmaps(tstamp_start, tstamp_end, device_ids):
+      if bits:
+        device = idToDevice(device_id)
+        counts[device] = counts.get(device, 0) + bin(bits).count("1")
+
+    return counts
+
+# Verify that the queries run by query() and iterIntervals() are served by
+# the indexes. Raises an AssertionError on a full table scan or on a non
+# covering lookup of the datapoints.
+def checkQueryPlans(presence, tstamp_start, tstamp_end, device_filter):
+  statements = []
+  presence.conn.set_trace_callback(statements.append)
+
+  for resolution in [None, "1h", "24h", "1M"]:
+    for device in [None, device_filter]:
+      presence.query(tstamp_start, tstamp_end, device_filter=device, resolution=resolution)
+      list(presence.iterIntervals(tstamp_start, tstamp_end, device_filter=device, resolution=resolution))
+
+  presence.conn.set_trace_callback(None)
+
+  for q in set(statements):
+    if not q.startswith("SELECT"):
+      continue
+
+    plan = [row[3] for row in presence.conn.execute("EXPLAIN QUERY PLAN " + q)]
+
+    for detail in plan:
+      assert detail.startswith("SEARCH ") or detail.startswith("USE TEMP B-TREE"), (q, plan)
+
+      if detail.startswith("SEARCH presence "):
+        assert ("COVERING INDEX" in detail) or ("PRIMARY KEY" in detail), (q, plan)
+
+    if (" FROM presence " in q) and (" ORDER BY " in q):
+      # Streamed datapoints must not be sorted in memory
+      assert(not [detail for detail in plan if detail.startswith("USE TEMP B-TREE")]), (q, plan)
+
+def benchmarkIntervals(num_devices=8, days=365):
+  import random, time
+  presence = PresenceDB(":memory:")
+  rows = []
+  rnd = random.Random(0)
+
+  # Synthetic data: devices going on and off every few hours
+  for device_id in range(num_devices):
+    present = True
+
+    for minute in range(days * 24 * 60):
+      if rnd.random() < 0.005:
+        present = not present
+      if present:
+        rows.append((1514764800 + minute * RESOLUTION, device_id))
+
+  print("Benchmarking %d datapoints, %d devices" % (len(rows), num_devices))
+  results = {}
+
+  for use_numpy in ([False, True] if numpy else [False]):
+    presence.use_numpy = use_numpy
+    start = time.time()
+    results[use_numpy] = presence._rowsToIntervals(rows, RESOLUTION)
+    print("%s: %.3f s" % ("numpy" if use_numpy else "python", time.time() - start))
+
+  if numpy:
+    assert(results[True] == results[False])
+  else:
+    print("numpy is not available")
 
 if __name__ == "__main__":
-  import time
-  tstamp = int(time.time())
-
-  presence = PresenceDB()
-  # presence.insert(1513444570, {
-    # "aa:bb:cc:dd:ee:ff": 1,
-  # })
-  print(presence.query(int(time.time())-9600, int(time.time())))
-  # print(presence.query(int(time.time())-9600, int(time.time()), "aa:bb:cc:dd:ee:ff"))
+  import os, sys, tempfile
+
+  if "bench" in sys.argv[1:]:
+    benchmarkIntervals()
+    sys.exit(0)
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    # Databases created by older versions are migrated on open
+    legacy_path = os.path.join(tmpdir, "legacy.db")
+    conn = sqlite3.connect(legacy_path)
+    conn.execute("CREATE TABLE presence (timestamp INTEGER NOT NULL, mac CHARACTER(12) NOT NULL, PRIMARY KEY (timestamp, mac))")
+    conn.execute("CREATE INDEX idx_presence_mac ON presence (mac)")
+    conn.executemany("INSERT INTO presence VALUES (?,?)", [(1513444560, "AABBCCDDEEFF"), (1513444620, "AABBCCDDEEFF")])
+    conn.commit()
+    conn.close()
+
+    presence = PresenceDB(legacy_path)
+    assert(presence.query(1513444560, 1513444620) == {"AA:BB:CC:DD:EE:FF": [(1513444560, 1513444620)]})
+    assert(presence.query(1513444560, 1513444620, resolution="1h") == {"AA:BB:CC:DD:EE:FF": [(1513444620, 1513444620)]})
+    assert(presence.cursor.execute("SELECT mac FROM presence LIMIT 1").fetchone()[0] == 0xAABBCCDDEEFF)
+
+    presence = PresenceDB(os.path.join(tmpdir, "presence.db"))
+    tstamp = 1513444560
+
+    # Two days of datapoints with a gap
+    for i in range(2 * 24 * 60):
+      if (i % 300) < 200:
+        presence.insert(tstamp + i * RESOLUTION, ["aa:bb:cc:dd:ee:ff"] + (["11:22:33:44:55:66"] if i % 2 else []))
+
+    # Rollups must match the intervals computed on the raw data
+    legacy = {
+      "24h": ("strftime('%s', strftime('%Y-%m-%d', timestamp, 'unixepoch'), 'utc')", "strftime('%m-%d', datetime(timestamp, 'unixepoch'))"),
+      "1M": ("strftime('%s', strftime('%Y-%m-01 00:00:00', timestamp, 'unixepoch'), 'utc')", "strftime('%Y-%m', datetime(timestamp, 'unixepoch'))"),
+    }
+
+    for resolution, (time_what, group_by) in legacy.items():
+      res = presence.cursor.execute("SELECT " + time_what + ", mac FROM presence WHERE timestamp >= ? AND timestamp <= ? GROUP BY " + group_by + ", mac",
+        (tstamp, tstamp + 86400 * 3))
+      expected = presence._getIntervals(presence._groupByDevice(res), ROLLUPS[resolution][3])
+      assert(presence.query(tstamp, tstamp + 86400 * 3, resolution=resolution) == expected)
+
+    res = presence.query(tstamp, tstamp + 86400, device_filter="aa:bb:cc:dd:ee:ff", resolution="1h")
+    assert(list(res.keys()) == ["AA:BB:CC:DD:EE:FF"])
+    # 1h buckets report the last datapoint of each hour
+    assert(res["AA:BB:CC:DD:EE:FF"][0][0] == tstamp - (tstamp % 3600) + 3600 - RESOLUTION)
+
+    # The backfill must reproduce the incrementally maintained rollups
+    hourly = presence.cursor.execute("SELECT * FROM presence_hourly ORDER BY bucket, mac").fetchall()
+    presence.rebuildRollups()
+    assert(presence.cursor.execute("SELECT * FROM presence_hourly ORDER BY bucket, mac").fetchall() == hourly)
+
+    # Bitmaps queries must match the datapoints
+    assert(presence.presentAt(tstamp) == ["AA:BB:CC:DD:EE:FF"])
+    assert(presence.presentAt(tstamp + RESOLUTION + 30) == ["11:22:33:44:55:66", "AA:BB:CC:DD:EE:FF"])
+    assert(presence.presentAt(tstamp + 250 * RESOLUTION) == [])
+
+    for start, end in [(tstamp, tstamp + 86400 * 3), (tstamp + 3000.5, tstamp + 86400 + 99)]:
+      res = presence.cursor.execute("SELECT mac, count(*) FROM presence WHERE timestamp >= ? AND timestamp <= ? GROUP BY mac", (start, end))
+      assert(presence.presenceMinutes(start, end) == dict([(idToDevice(device_id), count) for device_id, count in res]))
+
+      res = presence.cursor.execute("SELECT 0, timestamp FROM presence WHERE timestamp >= ? AND timestamp <= ? GROUP BY timestamp HAVING count(*) = 2 ORDER BY timestamp", (start, end))
+      together = [(start, end) for _, start, end in presence._mergePoints(res)]
+      assert(presence.presentTogether(start, end, ["aa:bb:cc:dd:ee:ff", "11:22:33:44:55:66"]) == together)
+
+    assert(presence.presenceMinutes(tstamp, tstamp + 599, "11:22:33:44:55:66") == {"11:22:33:44:55:66": 5})
+    assert(presence.presentTogether(tstamp + 86400 * 7, tstamp + 86400 * 8, ["aa:bb:cc:dd:ee:ff"]) == [])
+
+    bitmaps = presence.cursor.execute("SELECT * FROM presence_bitmaps ORDER BY day, mac").fetchall()
+    presence.rebuildRollups()
+    assert(presence.cursor.execute("SELECT * FROM presence_bitmaps ORDER BY day, mac").fetchall() == bitmaps)
+
+    # Switching to the intervals storage must preserve the query results
+    minutes = presence.query(tstamp + 3000.5, tstamp + 86400 + 99)
+    presence = PresenceDB(os.path.join(tmpdir, "presence.db"), storage_mode="intervals")
+    assert(presence.cursor.execute("SELECT count(*) FROM presence").fetchone()[0] == 0)
+    assert(presence.cursor.execute("SELECT count(*) FROM presence_intervals WHERE mac = ?", (deviceToId("aa:bb:cc:dd:ee:ff"),)).fetchone()[0] == 10)
+    assert(presence.query(tstamp + 3000.5, tstamp + 86400 + 99) == minutes)
+    assert(len(list(presence.iterIntervals(tstamp + 3000.5, tstamp + 86400 + 99))) == sum([len(v) for v in minutes.values()]))
+    checkQueryPlans(presence, tstamp, tstamp + 86400 * 3, "aa:bb:cc:dd:ee:ff")
+
+    presence.rebuildRollups()
+    assert(presence.cursor.execute("SELECT * FROM presence_hourly ORDER BY bucket, mac").fetchall() == hourly)
+
+    assert(presence.cursor.execute("SELECT * FROM presence_bitmaps ORDER BY day, mac").fetchall() == bitmaps)
+
+    # Consecutive datapoints extend the open interval
+    later = tstamp + 86400 * 7
+    presence.insert(later, ["aa:bb:cc:dd:ee:ff"])
+    presence.insert(later + RESOLUTION, ["aa:bb:cc:dd:ee:ff"])
+    presence.insert(later + 3 * RESOLUTION, ["aa:bb:cc:dd:ee:ff"])
+    assert(presence.query(later, later + 3600) == {"AA:BB:CC:DD:EE:FF": [(later, later + RESOLUTION), (later + 3 * RESOLUTION, later + 3 * RESOLUTION)]})
+    assert(presence.presentTogether(later, later + 3600, ["aa:bb:cc:dd:ee:ff"]) == [(later, later + RESOLUTION), (later + 3 * RESOLUTION, later + 3 * RESOLUTION)])
+
+    # And back to the points storage
+    presence = PresenceDB(os.path.join(tmpdir, "presence.db"), storage_mode="points")
+    assert(presence.cursor.execute("SELECT count(*) FROM presence_intervals").fetchone()[0] == 0)
+    assert(presence.query(tstamp + 3000.5, tstamp + 86400 + 99) == minutes)
+
+    # The streamed intervals must match the query ones
+    for resolution in [None, "1h", "24h", "1M"]:
+      expected = presence.query(tstamp, tstamp + 86400 * 3, resolution=resolution)
+      streamed = {}
+
+      for device, start, end in presence.iterIntervals(tstamp, tstamp + 86400 * 3, resolution=resolution):
+        streamed.setdefault(device, []).append((start, end))
+      assert(streamed == expected)
+
+    # The vectorized intervals must match the python ones
+    if numpy:
+      for resolution in [None, "1h", "24h", "1M"]:
+        presence.use_numpy = False
+        expected = presence.query(tstamp, tstamp + 86400 * 3, resolution=resolution)
+        presence.use_numpy = True
+        assert(presence.query(tstamp, tstamp + 86400 * 3, resolution=resolution) == expected)
+
+    checkQueryPlans(presence, tstamp, tstamp + 86400 * 3, "aa:bb:cc:dd:ee:ff")
+
+    # Compact the minute datapoints of the first day
+    hourly = presence.cursor.execute("SELECT * FROM presence_hourly ORDER BY bucket, mac").fetchall()
+    before = tstamp + 86400
+    old_datapoints = presence.cursor.execute("SELECT count(*) FROM presence WHERE timestamp < ?", (before,)).fetchone()[0]
+    assert(sum(presence.compact("1m", before, 6 * 3600)) == old_datapoints)
+    assert(presence.cursor.execute("SELECT count(*) FROM presence WHERE timestamp < ?", (before,)).fetchone()[0] == 0)
+    assert(presence.cursor.execute("SELECT count(*) FROM presence WHERE timestamp >= ?", (before,)).fetchone()[0] > 0)
+    assert(presence.cursor.execute("SELECT * FROM presence_hourly ORDER BY bucket, mac").fetchall() == hourly)
+
+    # Compacted ranges are served by the coarser rollups
+    assert(presence.query(tstamp, tstamp + 3600) == presence.query(tstamp, tstamp + 3600, resolution="1h"))
+    assert(presence.query(before, before + 3600) != presence.query(before, before + 3600, resolution="1h"))
+    presence.vacuum(100)
+
+    # Compacting the hourly rollup preserves the daily one
+    daily = presence.cursor.execute("SELECT * FROM presence_daily ORDER BY bucket, mac").fetchall()
+    list(presence.compact("1h", before, 86400))
+    assert(presence.cursor.execute("SELECT count(*) FROM presence_hourly WHERE last < ?", (before,)).fetchone()[0] == 0)
+    assert(presence.cursor.execute("SELECT * FROM presence_daily ORDER BY bucket, mac").fetchall() == daily)
+    assert(presence.query(tstamp, tstamp + 3600, resolution="1h") == presence.query(tstamp, tstamp + 3600, resolution="24h"))
+    assert(presence.cursor.execute("SELECT count(*) FROM presence_bitmaps WHERE day + 86400 <= ?", (before,)).fetchone()[0] == 0)
+
+    # Compaction of the intervals storage
+    presence = PresenceDB(os.path.join(tmpdir, "intervals.db"), storage_mode="intervals")
+    presence.insert(tstamp, ["aa:bb:cc:dd:ee:ff"])
+    presence.insert(tstamp + RESOLUTION, ["aa:bb:cc:dd:ee:ff"])
+    presence.insert(tstamp + 3600, ["aa:bb:cc:dd:ee:ff"])
+    assert(sum(presence.compact("1m", tstamp + 600, 3600)) == 1)
+    assert(presence.query(tstamp + 3600, tstamp + 7200) == {"AA:BB:CC:DD:EE:FF": [(tstamp + 3600, tstamp + 3600)]})
+    assert(presence.query(tstamp, tstamp + 7200) == presence.query(tstamp, tstamp + 7200, resolution="1h"))
+
+    # Read only connections see the writer data but cannot modify it
+    reader = PresenceDB(os.path.join(tmpdir, "intervals.db"), storage_mode="intervals", readonly=True)
+    assert(reader.query(tstamp, tstamp + 7200) == presence.query(tstamp, tstamp + 7200))
+    presence.insert(tstamp + 3600 + RESOLUTION, ["aa:bb:cc:dd:ee:ff"])
+    assert(reader.query(tstamp + 3600, tstamp + 7200) == {"AA:BB:CC:DD:EE:FF": [(tstamp + 3600, tstamp + 3600 + RESOLUTION)]})
+
+    try:
+      reader.insert(tstamp + 7200, ["aa:bb:cc:dd:ee:ff"])
+      assert(False)
+    except sqlite3.OperationalError:
+      pass
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+#
+# netwatch
+# (C) 2017-20 Emanuele Faranda
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+from utils.jobs import Job
+from presence_db import PresenceDB, COMPACTION
+import config
+
+RETENTION_CHECK_INTERVAL = 3600
+BATCH_SECONDS = 6 * 3600
+BATCH_PAUSE = 0.5
+VACUUM_PAGES = 256
+
+# Periodically compacts the presence data older than the configured retention
+# into the coarser resolutions. The work is split into small transactions,
+# with a pause between them, so that the main loop datapoints flush is never
+# blocked for long.
+class RetentionJob(Job):
+  def __init__(self):
+    super(RetentionJob, self).__init__("RetentionJob", self.task)
+
+  def applyRetention(self, presence_db, now):
+    retention = config.getRetentionDays()
+    before = now
+
+    # Walk from the finest resolution. A resolution is never compacted past
+    # the finer ones, since they rely on it.
+    for resolution in COMPACTION.keys():
+      days = retention.get(resolution, 0)
+
+      if not days:
+        break
+
+      before = min(before, now - days * 86400)
+      deleted = 0
+
+      for num_rows in presence_db.compact(resolution, before, BATCH_SECONDS):
+        deleted += num_rows
+
+        if num_rows:
+          presence_db.vacuum(VACUUM_PAGES)
+
+        if not self.isRunning():
+          return
+
+        time.sleep(BATCH_PAUSE)
+
+      if deleted:
+        print("Retention: compacted %d rows of the %s data" % (deleted, resolution))
+
+  def task(self, _):
+    presence_db = PresenceDB()
+    next_check = 0
+
+    while self.isRunning():
+      now = time.time()
+
+      if now >= next_check:
+        config.reload()
+        self.applyRetention(presence_db, int(now))
+        next_check = now + RETENTION_CHECK_INTERVAL
+
+      time.sleep(1)
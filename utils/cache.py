@@ -0,0 +1,143 @@
+#
+# netwatch
+# (C) 2017-20 Emanuele Faranda
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+import threading
+import pickle
+import time
+import os
+
+# Minimum seconds between two saves of a persisted cache
+PERSIST_INTERVAL = 30
+
+# A thread safe LRU cache, holding at most max_entries values. When
+# persist_path is set, the entries are loaded from it, and saved back by a
+# background thread at most every persist_interval seconds after a put.
+class LRUCache():
+  def __init__(self, max_entries, persist_path=None, persist_interval=PERSIST_INTERVAL):
+    self.max_entries = max_entries
+    self.persist_path = persist_path
+    self.persist_interval = persist_interval
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.save_lock = threading.Lock()
+    self.dirty = threading.Event()
+    self.hits = 0
+    self.misses = 0
+
+    if persist_path:
+      self._load()
+      threading.Thread(target=self._persistLoop, daemon=True).start()
+
+  def _load(self):
+    try:
+      with open(self.persist_path, "rb") as f:
+        entries = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      return
+
+    for key, value in entries:
+      self.entries[key] = value
+
+    self._evict()
+
+  def _persistLoop(self):
+    while True:
+      self.dirty.wait()
+      # Coalesce the puts of the interval into a single save
+      time.sleep(self.persist_interval)
+      self.flush()
+
+  # Save the entries now. The file is written without holding the cache lock.
+  def flush(self):
+    with self.save_lock:
+      self.dirty.clear()
+
+      with self.lock:
+        entries = list(self.entries.items())
+
+      tmp_path = self.persist_path + ".tmp"
+
+      try:
+        with open(tmp_path, "wb") as f:
+          pickle.dump(entries, f)
+
+        # Atomically replace the old file
+        os.replace(tmp_path, self.persist_path)
+      except OSError:
+        pass
+
+  def _evict(self):
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+  # Returns the cached value, or None
+  def get(self, key):
+    with self.lock:
+      value = self.entries.get(key)
+
+      if value is None:
+        self.misses += 1
+      else:
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      self._evict()
+
+    if self.persist_path:
+      self.dirty.set()
+
+  def __len__(self):
+    return len(self.entries)
+
+if __name__ == "__main__":
+  import tempfile
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, "cache.pickle")
+    cache = LRUCache(2, path)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert(cache.get("a") == 1)
+
+    # "b" is the least recently used
+    cache.put("c", 3)
+    assert(cache.get("b") is None)
+    assert((cache.hits, cache.misses) == (1, 1))
+
+    # The puts are not saved until the interval elapses, or a flush
+    assert(not os.path.exists(path))
+    cache.flush()
+
+    cache = LRUCache(1, path)
+    assert(len(cache) == 1)
+    assert(cache.get("c") == 3)
+
+    # Background save
+    path = os.path.join(tmpdir, "cache2.pickle")
+    cache = LRUCache(2, path, persist_interval=0.1)
+    cache.put("a", 1)
+    time.sleep(0.5)
+    assert(LRUCache(2, path).get("a") == 1)
@@ -23,12 +23,13 @@ import config
 def isActiveDevice(metadata):
   return (time.time() - metadata["last_seen"]) <= config.MAX_HOST_IDLE_SEC
 
-def countActiveUserDevices(devices_list, meta_db):
+# devices_metadata is a mac -> metadata dict, as returned by MetaDB.queryMany
+def countActiveUserDevices(devices_list, devices_metadata):
   count = 0
   activity_count = 0
 
   for mac in devices_list:
-    metadata = meta_db.query(mac)
+    metadata = devices_metadata.get(mac)
 
     if metadata and isActiveDevice(metadata):
       count += 1
@@ -41,9 +42,11 @@ def countActiveUserDevices(devices_list, meta_db):
 
 def getDevicesData(meta_db):
   res = []
+  configured_devices = config.getConfiguredDevices()
+  devices_metadata = meta_db.queryMany(configured_devices.keys())
 
-  for mac, value in config.getConfiguredDevices().items():
-    metadata = meta_db.query(mac)
+  for mac, value in configured_devices.items():
+    metadata = devices_metadata.get(mac)
     device_ip = "-"
     device_active = "false"
     devname = value["custom_name"]
@@ -68,9 +71,11 @@ def getDevicesData(meta_db):
 
 def getUsersData(meta_db):
   res = []
+  users = config.getConfiguredUsers()
+  devices_metadata = meta_db.queryMany([mac for value in users.values() for mac in value["devices"]])
 
-  for username, value in config.getConfiguredUsers().items():
-    num_active_devices, num_activity_devices = countActiveUserDevices(value["devices"], meta_db)
+  for username, value in users.items():
+    num_active_devices, num_activity_devices = countActiveUserDevices(value["devices"], devices_metadata)
 
     res.append({
       "name": username,
@@ -81,22 +86,3 @@ def getUsersData(meta_db):
     })
 
   return res
-
-# Returns: captive_portal|pass|block
-def getDevicePolicy(mac):
-  mac_info = config.getDeviceInfo(mac)
-
-  if mac_info:
-    policy = mac_info.get("policy", "default")
-
-    if not policy:
-      policy = "default"
-
-    if policy != "default":
-      return(policy)
-
-  # Default policy
-  if config.getCaptivePortalEnabled():
-    return "captive_portal"
-
-  return "pass"
@@ -17,6 +17,14 @@
 #
 
 import socket, struct
+import sqlite3
+from functools import lru_cache
+from urllib.parse import quote
+
+DEVICE_ID_CACHE_SIZE = 4096
+
+# Page cache size of the read only connections, in KiB
+READONLY_CACHE_KIB = 8192
 
 def deviceToKey(device):
   return "".join(device.upper().split(":"))
@@ -24,6 +32,15 @@ def deviceToKey(device):
 def keyToDevice(key):
   return ":".join([key[i:i+2] for i in range(0, len(key), 2)])
 
+# Devices are stored into the databases as 48-bit integers
+@lru_cache(maxsize=DEVICE_ID_CACHE_SIZE)
+def deviceToId(device):
+  return int(deviceToKey(device), 16)
+
+@lru_cache(maxsize=DEVICE_ID_CACHE_SIZE)
+def idToDevice(device_id):
+  return keyToDevice("%012X" % device_id)
+
 def ip2long(ip):
   packedIP = socket.inet_aton(ip)
   return struct.unpack("!L", packedIP)[0]
@@ -31,3 +48,38 @@ def ip2long(ip):
 def long2ip(l):
   if l == None: return None
   return socket.inet_ntoa(struct.pack('!L', l))
+
+# Connection settings shared by the databases. WAL lets readers run concurrently
+# with the writer and, with synchronous=NORMAL, commits do not need an fsync.
+def initConnection(conn):
+  conn.execute("PRAGMA journal_mode = WAL")
+  conn.execute("PRAGMA synchronous = NORMAL")
+
+# Open a connection which can only run queries. The schema is not initialized,
+# it must have been already created by the writer.
+def connectReadOnly(db_path):
+  conn = sqlite3.connect("file:%s?mode=ro" % quote(db_path), uri=True)
+  conn.execute("PRAGMA query_only = ON")
+  conn.execute("PRAGMA cache_size = -%d" % READONLY_CACHE_KIB)
+  return conn
+
+# Recreate the existing tables with the schema made by create_tables, copying
+# their rows. column_exprs maps a column to the SQL expression to convert it.
+def migrateTables(cursor, create_tables, column_exprs):
+  tables = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()]
+  indexes = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall()]
+
+  # Indexes would otherwise follow the renamed tables
+  for index in indexes:
+    cursor.execute("DROP INDEX %s" % index)
+
+  for table in tables:
+    cursor.execute("ALTER TABLE %s RENAME TO %s_old" % (table, table))
+
+  create_tables()
+
+  for table in tables:
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(%s_old)" % table).fetchall()]
+    cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s_old" % (table, ", ".join(columns),
+      ", ".join([column_exprs.get(column, column) for column in columns]), table))
+    cursor.execute("DROP TABLE %s_old" % table)
@@ -18,16 +18,95 @@
 
 # NOTE: use multiprocessing instead of threading to make things go smooth
 # The Global Interpreter Lock slows down web server a lot!
-from multiprocessing import Queue, Event, Process
+from multiprocessing import Queue, SimpleQueue, Process
 from queue import Empty as QueueEmpty
+from utils.shm_ring import ShmRing
+from message import Messages
 import signal
+import select
 import os
 
+# The available transports of the messages queues
+TRANSPORTS = ("queue", "shm")
+
+# A multiprocessing Event which can also be monitored with select/selectors,
+# via fileno(). It is backed by a pipe, so it must be created before forking
+# the processes which use it, and only one process should clear it.
+class FdEvent(object):
+  def __init__(self):
+    self._rfd, self._wfd = os.pipe()
+    os.set_blocking(self._rfd, False)
+    os.set_blocking(self._wfd, False)
+
+  def fileno(self):
+    return self._rfd
+
+  def set(self):
+    try:
+      os.write(self._wfd, b"\0")
+    except BlockingIOError:
+      # The pipe is full, the event is already set
+      pass
+
+  def is_set(self):
+    return self.wait(0)
+
+  def wait(self, timeout=None):
+    readable, _, _ = select.select([self._rfd], [], [], timeout)
+    return bool(readable)
+
+  def clear(self):
+    try:
+      while os.read(self._rfd, 4096):
+        pass
+    except BlockingIOError:
+      pass
+
+# A messages queue which moves the batches of Message from a single producer
+# job through a ShmRing. Any other object is sent via a SimpleQueue, which
+# unlike Queue writes it before put returns. A FdEvent signals the consumer
+# when new messages are available.
+class ShmMessageQueue(object):
+  def __init__(self):
+    self.ring = ShmRing()
+    self.queue = SimpleQueue()
+    self.doorbell = FdEvent()
+
+  def put(self, obj):
+    if type(obj) == Messages:
+      self.ring.put(obj, obj.tstamp)
+    else:
+      self.queue.put(obj)
+
+    self.doorbell.set()
+
+  # Returns the pending messages, waiting up to timeout seconds for them
+  def drain(self, timeout=0):
+    if timeout > 0:
+      self.doorbell.wait(timeout)
+
+    # Clear before draining, so that a put made meanwhile is not lost
+    self.doorbell.clear()
+    messages = []
+
+    # The queue is drained first, so that the ring contains all the batches
+    # put before the other objects
+    while not self.queue.empty():
+      messages.append(self.queue.get())
+
+    return self.ring.drain() + messages
+
+  def stats(self):
+    return self.ring.stats()
+
+  def close(self):
+    self.ring.close(unlink=True)
+
 class Job(object):
   def __init__(self, idenfier, task, force_kill=False):
     self.id = idenfier
     self.task = task
-    self._stopped = Event()
+    self._stopped = FdEvent()
     self.options = {}
     self.force_kill = force_kill
 
@@ -43,6 +122,10 @@ class Job(object):
   def isRunning(self):
     return not self.isTerminating()
 
+  # Readable when the job is asked to terminate
+  def terminationFileno(self):
+    return self._stopped.fileno()
+
   def readOptions(self, options):
     self.options = options
 
@@ -52,10 +135,12 @@ class ManagedJob(object):
     self.thread = thread
 
 # Manages jobs. Jobs with the same identifier can only run one at a time.
+# The transport, one of TRANSPORTS, is used for the messages sent by the jobs
+# to the manager.
 class JobsManager:
-  def __init__(self, global_options):
+  def __init__(self, global_options, transport="queue"):
     self.running = {}
-    self.msg_queue = Queue()
+    self.msg_queue = self.newQueue(transport)
     self.global_options = global_options
 
   def _execJob(self, job, *args):
@@ -73,10 +158,17 @@ class JobsManager:
     for job_id in jobs_removed:
       del self.running[job_id]
 
-  def getMessages(self):
+  # Returns the pending messages, waiting up to timeout seconds for the first one
+  def getMessages(self, timeout=0):
+    if isinstance(self.msg_queue, ShmMessageQueue):
+      return self.msg_queue.drain(timeout)
+
     messages = []
 
     try:
+      if timeout > 0:
+        messages.append(self.msg_queue.get(timeout=timeout))
+
       while True:
         msg = self.msg_queue.get(block=False)
         messages.append(msg)
@@ -107,8 +199,25 @@ class JobsManager:
     signal.signal(signal.SIGHUP, old_sighup_handler)
     return True
 
-  def newQueue(self):
-    return Queue()
+  def newQueue(self, transport="queue"):
+    if transport == "shm":
+      return ShmMessageQueue()
+    elif transport == "queue":
+      return Queue()
+
+    raise ValueError("Unknown transport: " + transport)
+
+  # Returns the counters of the messages transport, None if not available
+  def getTransportStats(self):
+    if isinstance(self.msg_queue, ShmMessageQueue):
+      return self.msg_queue.stats()
+
+    return None
+
+  # Release the messages transport, after the jobs termination
+  def close(self):
+    if isinstance(self.msg_queue, ShmMessageQueue):
+      self.msg_queue.close()
 
   def getRunning(self):
     self._checkJoin()
@@ -141,7 +250,15 @@ if __name__ == "__main__":
     time.sleep(seconds)
     msg_queue.put(seconds)
 
-  manager = JobsManager()
+  ev = FdEvent()
+  assert(not ev.is_set())
+  ev.set()
+  ev.set()
+  assert(ev.is_set() and ev.wait(0))
+  ev.clear()
+  assert(not ev.wait(0.1))
+
+  manager = JobsManager({})
   manager.runJob(Job("sleep_2", sleeper_task), (2, ))
   manager.runJob(Job("sleep_5", sleeper_task), (5, ))
   manager.runJob(Job("sleep_2", sleeper_task), (2, ))
@@ -162,3 +279,18 @@ if __name__ == "__main__":
   messages = manager.getMessages()
   assert(2 in messages)
   assert(5 in messages)
+
+  def hosts_task(msg_queue):
+    from message import Message
+    msg_queue.put(Messages([Message("AA:BB:CC:DD:EE:FF", "192.168.1.2", 1000)]))
+    msg_queue.put("done")
+
+  manager = JobsManager({}, transport="shm")
+  manager.runJob(Job("hosts", hosts_task))
+  manager.join(wait=True)
+
+  messages = manager.getMessages(1)
+  assert((len(messages) == 2) and (messages[1] == "done"))
+  assert([msg.mac for msg in messages[0]] == ["AA:BB:CC:DD:EE:FF"])
+  assert(manager.getTransportStats() == {"overflows": 0, "names_overflows": 0})
+  manager.close()
@@ -0,0 +1,303 @@
+#
+# netwatch
+# (C) 2017-20 Emanuele Faranda
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from multiprocessing import shared_memory
+import multiprocessing
+import socket
+import struct
+import os
+
+from message import Message, Messages
+
+DEFAULT_RING_RECORDS = 4096
+DEFAULT_RING_NAMES = 1024
+
+# head, tail, names head, names tail, overflows, names overflows, producer pid, unused
+HEADER = struct.Struct("<8Q")
+HEAD, TAIL, NAMES_HEAD, NAMES_TAIL, OVERFLOWS, NAMES_OVERFLOWS, PRODUCER_PID = range(7)
+
+# mac, batch tstamp, seen tstamp, ip, count, name slot (-1 if no name)
+RECORD = struct.Struct("<QddIIi4x")
+
+# length, utf-8 name
+NAME = struct.Struct("<B63s")
+NAME_MAX_LEN = 63
+
+U64 = struct.Struct("<Q")
+
+def macToInt(mac):
+  return int(mac.replace(":", ""), 16)
+
+def intToMac(val):
+  return ":".join(["%02X" % b for b in val.to_bytes(6, "big")])
+
+def ipToInt(ip):
+  return int.from_bytes(socket.inet_aton(ip), "big")
+
+def intToIp(val):
+  return socket.inet_ntoa(struct.pack("!I", val))
+
+# A single producer, single consumer ring of the hosts sightings, in shared
+# memory. Each Message is stored as a fixed size record, with its name, if any,
+# stored into a smaller ring of names. The ring must be created before forking
+# the producer and the consumer.
+#
+# Counters only grow, the slot is the counter modulo the ring size. The
+# producer writes the records before publishing the new head, the consumer
+# reads them before publishing the new tail. The counters are only accessed
+# under the lock, whose acquire and release are memory barriers, so that the
+# records are visible before the counters on any architecture. The lock is
+# taken once per batch.
+#
+# When the ring is full, the records are dropped and counted as overflows.
+class ShmRing(object):
+  def __init__(self, num_records=DEFAULT_RING_RECORDS, num_names=DEFAULT_RING_NAMES):
+    self.num_records = num_records
+    self.num_names = num_names
+    self.records_offset = HEADER.size
+    self.names_offset = self.records_offset + num_records * RECORD.size
+
+    self.shm = shared_memory.SharedMemory(create=True, size=(self.names_offset + num_names * NAME.size))
+    self.buf = self.shm.buf
+    HEADER.pack_into(self.buf, 0, *([0] * 8))
+    self.lock = multiprocessing.Lock()
+
+    # The same hosts are seen over and over, cache their conversions
+    self.packed_cache = {}
+    self.unpacked_cache = {}
+
+  def _get(self, field):
+    return U64.unpack_from(self.buf, field * U64.size)[0]
+
+  def _set(self, field, value):
+    U64.pack_into(self.buf, field * U64.size, value)
+
+  # Producer: store the messages of the batch. Returns the number of stored messages.
+  def put(self, messages, tstamp):
+    pid = os.getpid()
+    stored = 0
+
+    with self.lock:
+      head, tail, names_head, names_tail, overflows, names_overflows, producer_pid, _ = HEADER.unpack_from(self.buf, 0)
+
+      if producer_pid != pid:
+        if producer_pid:
+          raise RuntimeError("ShmRing supports a single producer")
+
+        self._set(PRODUCER_PID, pid)
+
+    if len(self.packed_cache) > self.num_records:
+      self.packed_cache = {}
+
+    packed_cache = self.packed_cache
+
+    for msg in messages:
+      if (head - tail) >= self.num_records:
+        overflows += 1
+        continue
+
+      key = (msg.mac, msg.ip)
+      packed = packed_cache.get(key)
+
+      if packed is None:
+        packed = packed_cache[key] = (macToInt(msg.mac), ipToInt(msg.ip or "0.0.0.0"))
+
+      name_slot = -1
+
+      if msg.host_name:
+        if (names_head - names_tail) >= self.num_names:
+          names_overflows += 1
+        else:
+          name = msg.host_name.encode("utf-8")[:NAME_MAX_LEN]
+          name_slot = names_head % self.num_names
+          NAME.pack_into(self.buf, self.names_offset + name_slot * NAME.size, len(name), name)
+          names_head += 1
+
+      RECORD.pack_into(self.buf, self.records_offset + (head % self.num_records) * RECORD.size,
+        packed[0], tstamp, msg.seen_tstamp, packed[1], msg.count, name_slot)
+      head += 1
+      stored += 1
+
+    # Publish the records and names written above
+    with self.lock:
+      self._set(NAMES_HEAD, names_head)
+      self._set(HEAD, head)
+      self._set(OVERFLOWS, overflows)
+      self._set(NAMES_OVERFLOWS, names_overflows)
+
+    return stored
+
+  # Consumer: returns the pending records as a list of Messages, one per put batch
+  def drain(self):
+    with self.lock:
+      head = self._get(HEAD)
+      tail = self._get(TAIL)
+      names_tail = self._get(NAMES_TAIL)
+
+    batches = []
+    batch = None
+
+    if len(self.unpacked_cache) > self.num_records:
+      self.unpacked_cache = {}
+
+    unpacked_cache = self.unpacked_cache
+
+    while tail < head:
+      # Unpack the records up to the end of the ring in one go
+      slot = tail % self.num_records
+      num = min(head - tail, self.num_records - slot)
+      start = self.records_offset + slot * RECORD.size
+
+      for mac, tstamp, seen_tstamp, ip, count, name_slot in RECORD.iter_unpack(self.buf[start:start + num * RECORD.size]):
+        key = (mac, ip)
+        unpacked = unpacked_cache.get(key)
+
+        if unpacked is None:
+          unpacked = unpacked_cache[key] = (intToMac(mac), intToIp(ip))
+
+        msg = Message(unpacked[0], unpacked[1], seen_tstamp)
+        msg.count = count
+
+        if name_slot >= 0:
+          length, name = NAME.unpack_from(self.buf, self.names_offset + name_slot * NAME.size)
+          msg.host_name = name[:length].decode("utf-8", "replace")
+          names_tail += 1
+
+        if (batch is None) or (batch.tstamp != tstamp):
+          batch = Messages([])
+          batch.tstamp = tstamp
+          batches.append(batch)
+
+        batch.messages.append(msg)
+
+      tail += num
+
+    # Release the slots read above
+    with self.lock:
+      self._set(NAMES_TAIL, names_tail)
+      self._set(TAIL, tail)
+
+    return batches
+
+  def stats(self):
+    with self.lock:
+      return {
+        "overflows": self._get(OVERFLOWS),
+        "names_overflows": self._get(NAMES_OVERFLOWS),
+      }
+
+  def close(self, unlink=False):
+    self.buf.release()
+    self.shm.close()
+
+    if unlink:
+      self.shm.unlink()
+
+if __name__ == "__main__":
+  import time
+  from multiprocessing import Process, Queue
+
+  assert(intToMac(macToInt("AA:BB:CC:00:11:22")) == "AA:BB:CC:00:11:22")
+  assert(intToIp(ipToInt("192.168.1.20")) == "192.168.1.20")
+
+  def makeMessages(num, base=0):
+    messages = []
+
+    for i in range(num):
+      msg = Message("AA:BB:CC:DD:%02X:%02X" % ((base + i) // 256 % 256, (base + i) % 256), "192.168.1.%d" % (i % 256), 1000.5 + i)
+      msg.count = i + 1
+      msg.host_name = ("host-%d" % i) if (i % 2) else None
+      messages.append(msg)
+
+    return messages
+
+  ring = ShmRing(8, 2)
+  assert(ring.put(makeMessages(3), 1.0) == 3)
+  assert(ring.put(makeMessages(2, 3), 2.0) == 2)
+  batches = ring.drain()
+  assert([(b.tstamp, len(b.messages)) for b in batches] == [(1.0, 3), (2.0, 2)])
+
+  msg = batches[0].messages[1]
+  assert((msg.mac, msg.ip, msg.seen_tstamp, msg.count, msg.host_name) == ("AA:BB:CC:DD:00:01", "192.168.1.1", 1001.5, 2, "host-1"))
+  assert(batches[1].messages[0].host_name == None)
+  assert(ring.drain() == [])
+
+  # Overflows
+  assert(ring.put(makeMessages(10), 3.0) == 8)
+  assert(ring.stats() == {"overflows": 2, "names_overflows": 2})
+  assert(len(ring.drain()[0].messages) == 8)
+
+  # Single producer
+  def otherProducer():
+    try:
+      ring.put(makeMessages(1), 4.0)
+      os._exit(1)
+    except RuntimeError:
+      os._exit(0)
+
+  p = Process(target=otherProducer)
+  p.start()
+  p.join()
+  assert(p.exitcode == 0)
+
+  ring.close(unlink=True)
+
+  # Throughput, from a producer process
+  num_batches = 2000
+  batch_size = 50
+
+  def producer(transport):
+    batch = makeMessages(batch_size)
+
+    for i in range(num_batches):
+      messages = batch
+
+      if isinstance(transport, ShmRing):
+        tstamp = time.time()
+
+        while messages:
+          # Wait for the consumer, as the test counts the messages
+          messages = messages[transport.put(messages, tstamp):]
+
+          if messages:
+            time.sleep(0.0005)
+      else:
+        transport.put(Messages(messages))
+
+  for name, transport in (("multiprocessing.Queue", Queue()), ("ShmRing", ShmRing())):
+    p = Process(target=producer, args=(transport,))
+    received = 0
+    start = time.time()
+    p.start()
+
+    while received < num_batches * batch_size:
+      if isinstance(transport, ShmRing):
+        batches = transport.drain()
+
+        if not batches:
+          time.sleep(0.0005)
+      else:
+        batches = [transport.get()]
+
+      received += sum([len(batch.messages) for batch in batches])
+
+    p.join()
+    print("%s: %.0f messages/s" % (name, received / (time.time() - start)))
+
+    if isinstance(transport, ShmRing):
+      transport.close(unlink=True)
@@ -19,9 +19,10 @@
 from flask import Flask, request, redirect, url_for, jsonify, render_template, send_from_directory
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.security import generate_password_hash, check_password_hash
-from presence_db import PresenceDB
+from presence_db import PresenceDB, RESOLUTION
 from meta_db import MetaDB
 from utils.jobs import Job
+from utils.cache import LRUCache
 from utils.data import getDevicesData, getUsersData
 from utils.timeutils import makeEndTimestamp
 import waitress
@@ -34,6 +35,10 @@ import multiprocessing
 
 # web.config.debug = False
 WEB_PORT = 8000
+
+# Intervals of the timeline windows already closed, which cannot change anymore
+TIMELINE_CACHE_ENTRIES = 256
+TIMELINE_CACHE_FILE = "data/timeline_cache.pickle"
 auth = HTTPBasicAuth()
 auth_username = None
 auth_password = None
@@ -76,6 +81,8 @@ class WebServerJob(Job):
     super(WebServerJob, self).__init__("web_server", self.run, force_kill=True)
 
     self.web_msgqueue = None
+    self.timeline_cache = None
+    self.local = threading.local()
     self.app = Flask("Netwatch",
       template_folder = './html',
       static_url_path = "/static")
@@ -114,14 +121,45 @@ class WebServerJob(Job):
   def GET_Static(self, path):
     return send_from_directory('js', path)
 
+  # Read only database handles, opened once per server thread
+  def getPresenceDB(self):
+    if not hasattr(self.local, "presence_db"):
+      self.local.presence_db = PresenceDB(readonly=True)
+
+    return self.local.presence_db
+
+  def getMetaDB(self):
+    if not hasattr(self.local, "meta_db"):
+      self.local.meta_db = MetaDB(readonly=True)
+
+    return self.local.meta_db
+
+  # Returns the (device, start, end) intervals of the time window, sorted by device
+  def getTimelineIntervals(self, presence_db, ts_start, ts_end, resolution, device_filter=None):
+    # A window is closed when no more datapoints can be inserted into it.
+    # Open windows bypass the cache.
+    if ts_end >= time.time() - 2 * RESOLUTION:
+      return list(presence_db.iterIntervals(ts_start, ts_end, device_filter=device_filter, resolution=resolution))
+
+    # The data of a closed window only changes when it is compacted, which
+    # changes the resolution used for the query
+    key = (ts_start, ts_end, resolution, device_filter, presence_db.availableResolution(ts_start, resolution))
+    intervals = self.timeline_cache.get(key)
+
+    if intervals is None:
+      intervals = list(presence_db.iterIntervals(ts_start, ts_end, device_filter=device_filter, resolution=resolution))
+      self.timeline_cache.put(key, intervals)
+
+    return intervals
+
   @check_auth
   def GET_Timeline(self):
     # TODO handle now
     timestamp = request.args.get('ts', "now")
     resolution = request.args.get('res', "1h")
 
-    presence_db = PresenceDB()
-    meta_db = MetaDB()
+    presence_db = self.getPresenceDB()
+    meta_db = self.getMetaDB()
     ts_start = None
     ts_end = None
 
@@ -132,27 +170,32 @@ class WebServerJob(Job):
       ts_start = int(timestamp)
       ts_end = makeEndTimestamp(ts_start, resolution)
 
-    presence_data = presence_db.query(ts_start, ts_end, resolution=resolution)
     configured_devices = config.getConfiguredDevices()
     min_time = resToMinTime(resolution)
 
     data = []
-    for device, intervals in presence_data.items():
-      name = device
-      name_on_packet = ""
+    cur_device = None
+    intervals = self.getTimelineIntervals(presence_db, ts_start, ts_end, resolution)
+    devices_metadata = meta_db.queryMany(set([device for device, _, _ in intervals]))
+
+    # Intervals are sorted by device
+    for device, start, end in intervals:
+      if device != cur_device:
+        cur_device = device
+        name = device
+        name_on_packet = ""
 
-      meta = meta_db.query(device)
+        meta = devices_metadata.get(device)
 
-      if meta and meta["name"]:
-        name_on_packet = meta["name"]
+        if meta and meta["name"]:
+          name_on_packet = meta["name"]
 
-      if device in configured_devices:
-        name = configured_devices[device]["custom_name"]
-      elif name_on_packet:
-        name = name_on_packet
+        if device in configured_devices:
+          name = configured_devices[device]["custom_name"]
+        elif name_on_packet:
+          name = name_on_packet
 
-      for interval in intervals:
-        data.append((name, "", interval[0], interval[1], device, name_on_packet))
+      data.append((name, "", start, end, device, name_on_packet))
 
     data.sort()
 
@@ -170,8 +213,7 @@ class WebServerJob(Job):
 
     if mode == "home":
       # Configured devices
-      meta_db = MetaDB()
-      return jsonify(getDevicesData(meta_db))
+      return jsonify(getDevicesData(self.getMetaDB()))
     else:
       self.web_msgqueue[0].send("get_seen_devices")
       known_macs = config.getConfiguredDevices().keys()
@@ -232,8 +274,7 @@ class WebServerJob(Job):
 
   @check_auth
   def GET_People_JSON(self):
-    meta_db = MetaDB()
-    return jsonify(getUsersData(meta_db))
+    return jsonify(getUsersData(self.getMetaDB()))
 
   @check_auth
   def POST_People(self):
@@ -276,6 +317,7 @@ class WebServerJob(Job):
   def run(self, _, web_msgqueue, config_changeev):
     self.web_msgqueue = web_msgqueue
     self.config_changeev = config_changeev
+    self.timeline_cache = LRUCache(TIMELINE_CACHE_ENTRIES, TIMELINE_CACHE_FILE)
     waitress.serve(self.app, port=WEB_PORT, threads=8)
 
 if __name__ == "__main__":